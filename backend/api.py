@@ -1,11 +1,42 @@
 from flask import jsonify, request
-from sqlalchemy.orm import sessionmaker,joinedload
+from sqlalchemy import delete, func, select
 from sqlalchemy.exc import IntegrityError
-from auth.token import token_required, hash_password
-from database import engine
+from auth.token import token_required, hash_password, invalidate_user, hasher_busy_response
+from auth.passwords import kdf_pool, HasherBusy
+from database import get_session, read_only, SessionLocal
 from models import Base
-from models import Book, Author, User, IssuedBook
-SessionLocal = sessionmaker(bind=engine)
+from models import Book, Author, Copy, User, IssuedBook
+from pagination import parse_page_args, apply_keyset, stream_json_array, YIELD_PER
+import schemas
+import search
+import suggest
+import circulation
+import recommend
+import exports
+import overdue
+import stats
+from table_versions import bump
+from response_cache import cached_response
+from bulk_import import BookImporter, BulkImportError, iter_records, DEFAULT_BATCH_SIZE, MAX_BATCH_SIZE
+
+# ids accepted by one DELETE /books call
+MAX_DELETE_IDS = 5000
+
+
+def issued_book_filters(args):
+    """WHERE clauses for the ?user_id=&book_id=&status= loan filters."""
+    criteria = []
+    user_id = args.get("user_id")
+    book_id = args.get("book_id")
+    status = args.get("status")
+
+    if user_id and user_id.isdigit():
+        criteria.append(IssuedBook.user_id == int(user_id))
+    if book_id and book_id.isdigit():
+        criteria.append(IssuedBook.book_id == int(book_id))
+    if status:
+        criteria.append(IssuedBook.status.ilike(f"%{status}%"))
+    return criteria
  
 def register_routes(app):
     @app.route("/")
@@ -20,77 +51,74 @@ def register_routes(app):
     @app.route("/books/search/<search_param>/<category>", defaults={"status": None, "author": None}, methods=["GET"])
     @app.route("/books/search/<search_param>/<category>/<status>", defaults={"author": None}, methods=["GET"])
     @app.route("/books/search/<search_param>/<category>/<status>/<author>", methods=["GET"])
+    @cached_response("books", "authors")
+    @read_only
     def search_books(search_param, category, status, author):
-        session = SessionLocal()
+        limit, after, error = parse_page_args()
+        if error:
+            return error
 
-        
-        query = session.query(Book).options(joinedload(Book.author))
-        if search_param:
-            sp = search_param.strip()
-            if sp.lower() == "all":
-                pass
-            elif sp.isdigit():
-                query = query.filter(Book.id == int(sp))
-            else:
-                query = query.filter(Book.title.ilike(f"%{sp}%"))
+        session = get_session()
 
-       
-        if category:
-            query = query.filter(Book.category.ilike(f"%{category}%"))
-        if status:
-            query = query.filter(Book.status.ilike(f"%{status}%"))
-        if author:
-            query = query.join(Author).filter(Author.name.ilike(f"%{author}%"))
-
-        books = query.all()
-
-        if not books:
-            session.close()
-            return jsonify({"message": "No books found"}), 404
-
-        result = [
-            {
-                "id": b.id,
-                "title": b.title,
-                "category": b.category,
-                "status": b.status,
-                "author_id": b.author_id,
-                "author_name": b.author.name if b.author else None
-            }
-            for b in books
-        ]
+        book_id, title, category, status, author = search.parse_search_path(
+            search_param, category, status, author
+        )
 
-        session.close()
-        return jsonify(result)
+        ranked, offset, error = search.page_order(
+            book_id, title, category, author,
+            request.args.get("order"), request.args.get("offset"), after,
+        )
+        if error:
+            return jsonify({"error": error}), 400
+
+        if ranked:
+            # text search: best matches first, paged with ?offset=
+            books = search.ranked_books(session, title, category, status, author, limit, offset)
+        else:
+            stmt = schemas.BOOK_SEARCH.select()
+            if book_id is not None:
+                stmt = stmt.where(Book.id == book_id)
+            stmt = search.apply_filters(stmt, title, category, status, author)
+            books = session.execute(apply_keyset(stmt, Book.id, limit, after))
+
+        return stream_json_array(
+            books,
+            schemas.BOOK_SEARCH.dump,
+            empty_response=(jsonify({"message": "No books found"}), 404),
+        )
+
+    @app.route("/suggest", methods=["GET"])
+    def suggest_titles():
+        # typeahead for the search box: answered from the in-memory index,
+        # never from the database (only the very first call waits for it)
+        query = request.args.get("q", "")
+        limit = request.args.get("limit", "")
+        if limit and not limit.isdigit():
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        limit = min(int(limit), suggest.MAX_LIMIT) if limit and int(limit) > 0 else suggest.DEFAULT_LIMIT
+
+        suggest.suggest_index.refresh(SessionLocal, wait=not suggest.suggest_index.ready())
+        return schemas.json_response(suggest.suggest_index.suggest(query, limit))
     
 
     @app.route("/books", methods=["GET"])
     @token_required
+    @cached_response("books", "authors")
+    @read_only
     def get_books():
-        session = SessionLocal()
-        books = session.query(Book).options(joinedload(Book.author)).all()
-        
-        result = [
-            {
-                "id": b.id,
-                "title": b.title,
-                "category": b.category,
-                "status": b.status,
-                "author_id": b.author_id,
-                "author_name": b.author.name if b.author else None,
-                "isbn": b.isbn
-            }
-            for b in books
-        ]
-        
-        session.close()
-        return jsonify(result)
+        limit, after, error = parse_page_args()
+        if error:
+            return error
+
+        session = get_session()
+        books = session.execute(apply_keyset(schemas.BOOK.select(), Book.id, limit, after))
+        return stream_json_array(books, schemas.BOOK.dump)
 
     @app.route("/books", methods=["POST"])
     @token_required
     def add_book():
         data = request.get_json() or {}
-        session = SessionLocal()
+        session = get_session()
 
         title = data.get("title")
         category = data.get("category")
@@ -101,7 +129,6 @@ def register_routes(app):
         author_name = data.get("author_name")
 
         if not title or not category or not isbn:
-            session.close()
             return jsonify({"error": "title, category, and isbn are required"}), 400
 
         # If author_name is provided instead of author_id, look it up
@@ -110,78 +137,231 @@ def register_routes(app):
             if author:
                 author_id = author.id
             else:
-                session.close()
                 return jsonify({"error": f"Author '{author_name}' not found"}), 404
         
         if not author_id:
-            session.close()
             return jsonify({"error": "author_id or author_name is required"}), 400
 
+        try:
+            copies = circulation.copy_count(data.get("copies"))
+        except circulation.CirculationError as e:
+            return jsonify({"error": e.message}), e.status_code
+
         new_book = Book(
             title=title,
             category=category,
             author_id=author_id,
-            isbn=isbn
+            isbn=isbn,
+            total_copies=copies,
+            available_copies=copies
         )
-        # Allow optional status override if provided
-        if data.get("status"):
-            new_book.status = data.get("status")
+        # status follows the copies (see circulation.py), so a "status" field
+        # is ignored: a new book has no loans and every copy is on the shelf
+        new_book.status = "available"
+        new_book.copies = [Copy(status="available") for _ in range(copies)]
         session.add(new_book)
         session.commit()
-        session.close()
+        bump("books", "copies")
+        search.book_index.invalidate()
+        suggest.suggest_index.add("book", new_book.id, new_book.title)
         return jsonify({"message": "Book added successfully!"})
     
 
+    @app.route("/books/bulk", methods=["POST"])
+    @token_required
+    def bulk_add_books():
+        # Accepts a JSON array, NDJSON (application/x-ndjson) or CSV (text/csv)
+        # with the same fields as POST /books. ?create_authors=true creates
+        # authors that do not exist yet instead of rejecting their rows.
+        create_authors = request.args.get("create_authors", "").lower() in ("1", "true", "yes")
+        batch_size = request.args.get("batch_size", "")
+        batch_size = min(int(batch_size), MAX_BATCH_SIZE) if batch_size.isdigit() and int(batch_size) > 0 else DEFAULT_BATCH_SIZE
+
+        session = get_session()
+        importer = BookImporter(session, create_authors=create_authors, batch_size=batch_size)
+        try:
+            result = importer.run(iter_records(request))
+        except BulkImportError as e:
+            session.rollback()
+            return jsonify({"error": str(e)}), 400
+        except UnicodeDecodeError:
+            session.rollback()
+            return jsonify({"error": "Upload must be UTF-8 encoded", **importer.summary()}), 400
+        finally:
+            if importer.inserted:
+                search.book_index.invalidate()
+                suggest.suggest_index.invalidate()
+                bump("books", "copies")
+            if importer.authors_created:
+                bump("authors")
+
+        return jsonify(result), 200
+
     @app.route("/books/<int:book_id>", methods=["DELETE"])
     @token_required
     def delete_book(book_id):
-        session = SessionLocal()
-    
-    
-        book = session.query(Book).get(book_id)
-        if not book:
-           session.close()
+        session = get_session()
+
+        # loans go with the book through ON DELETE CASCADE
+        deleted = session.execute(
+            delete(Book).where(Book.id == book_id), execution_options={"synchronize_session": False}
+        ).rowcount
+        if not deleted:
            return jsonify({"message": "Book not found"}), 404
 
-        session.delete(book)
         session.commit()
-        session.close()
+        bump("books", "copies", "issued_books")
+        search.book_index.invalidate()
+        suggest.suggest_index.remove("book", book_id)
         return jsonify({"message": f"Book with id {book_id} deleted successfully!"})
+
+    @app.route("/books/<int:book_id>/similar", methods=["GET"])
+    @token_required
+    @read_only
+    def similar_books(book_id):
+        # "readers who borrowed this also borrowed": ranked ids come from the
+        # in-memory index, one query fills in the books (and drops deleted ones)
+        limit = request.args.get("limit", "")
+        if limit and not limit.isdigit():
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        limit = min(int(limit), recommend.SIMILAR_TOP_N) if limit and int(limit) > 0 else recommend.DEFAULT_LIMIT
+
+        index = recommend.similar_books
+        index.refresh(SessionLocal, wait=not index.ready())
+        ranked = index.similar(book_id, limit)
+
+        session = get_session()
+        ids = [book_id] + [other for other, _, _ in ranked]
+        books = {
+            row.id: schemas.BOOK_SEARCH.dump(row)
+            for row in session.execute(schemas.BOOK_SEARCH.select().where(Book.id.in_(ids)))
+        }
+        if book_id not in books:
+            return jsonify({"message": "Book not found"}), 404
+        similar = [
+            {**books[other], "score": round(score, 4), "borrowed_together": count}
+            for other, score, count in ranked
+            if other in books
+        ]
+        return schemas.json_response({"book_id": book_id, "similar": similar})
+
+    @app.route("/books/<int:book_id>/copies", methods=["GET"])
+    @token_required
+    @read_only
+    def list_copies(book_id):
+        session = get_session()
+        copies = session.execute(
+            schemas.COPY.select().where(Copy.book_id == book_id).order_by(Copy.id)
+        ).all()
+        if not copies and session.get(Book, book_id) is None:
+            return jsonify({"message": "Book not found"}), 404
+        return schemas.json_response(schemas.COPY.dump_all(copies))
+
+    @app.route("/books/<int:book_id>/copies", methods=["POST"])
+    @token_required
+    def add_copies(book_id):
+        # {"count": n} shelves n more copies (default 1)
+        data = request.get_json(silent=True) or {}
+        session = get_session()
+        try:
+            count = circulation.copy_count(data.get("count"))
+            copy_ids = circulation.add_copies(session, book_id, count)
+        except circulation.CirculationError as e:
+            return jsonify({"error": e.message}), e.status_code
+        bump("books", "copies")
+        return jsonify({"book_id": book_id, "copy_ids": copy_ids}), 201
+
+    @app.route("/books/<int:book_id>/copies/<int:copy_id>", methods=["DELETE"])
+    @token_required
+    def withdraw_copy(book_id, copy_id):
+        session = get_session()
+        try:
+            circulation.withdraw_copy(session, book_id, copy_id)
+        except circulation.CirculationError as e:
+            return jsonify({"error": e.message}), e.status_code
+        bump("books", "copies")
+        return jsonify({"message": f"Copy {copy_id} withdrawn", "book_id": book_id})
     
+    @app.route("/books", methods=["DELETE"])
+    @token_required
+    def delete_books():
+        # {"ids": [...]} or {"filter": {"title", "category", "status", "author"}}
+        # (same substring filters as /books/search); one DELETE either way
+        data = request.get_json(silent=True) or {}
+        session = get_session()
+        ids = data.get("ids")
+        filters = data.get("filter")
+
+        if ids is not None:
+            if not isinstance(ids, list) or not ids:
+                return jsonify({"error": "ids must be a non-empty list"}), 400
+            if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+                return jsonify({"error": "ids must be integers"}), 400
+            if len(ids) > MAX_DELETE_IDS:
+                return jsonify({"error": f"At most {MAX_DELETE_IDS} ids per request"}), 400
+            criteria = [Book.id.in_(ids)]
+        elif isinstance(filters, dict):
+            unknown = set(filters) - {"title", "category", "status", "author"}
+            if unknown:
+                return jsonify({"error": f"Unknown filter fields: {', '.join(sorted(unknown))}"}), 400
+            criteria = search.filter_criteria(
+                filters.get("title"), filters.get("category"), filters.get("status"), filters.get("author")
+            )
+            if not criteria:
+                return jsonify({"error": "filter must set at least one field"}), 400
+        else:
+            return jsonify({"error": "ids or filter is required"}), 400
+
+        # loans are removed by the FK cascade; count them first so we can report it
+        loans = session.execute(
+            select(func.count(IssuedBook.id)).where(
+                IssuedBook.book_id.in_(select(Book.id).where(*criteria))
+            )
+        ).scalar()
+        deleted = session.execute(
+            delete(Book).where(*criteria), execution_options={"synchronize_session": False}
+        ).rowcount
+        session.commit()
+
+        if deleted:
+            bump("books", "copies", "issued_books")
+            search.book_index.invalidate()
+            suggest.suggest_index.invalidate()
+        return jsonify({"deleted": deleted, "issued_books_deleted": loans})
+
     @app.route("/authors", methods=["GET"])
+    @cached_response("authors")
+    @read_only
     def get_authors():
-        session = SessionLocal()
-        authors = session.query(Author).all()
-        result = [
-            {"id": a.id, "name": a.name, "bio": a.bio}
-            for a in authors
-        ]
-        session.close()
-        return jsonify(result)
+        session = get_session()
+        authors = session.execute(
+            schemas.AUTHOR.select().order_by(Author.id).execution_options(yield_per=YIELD_PER)
+        )
+        return stream_json_array(authors, schemas.AUTHOR.dump)
     
     @app.route("/authors", methods=["POST"])
     @token_required
     def add_author():
         data = request.get_json()
-        session = SessionLocal()
+        session = get_session()
         new_author = Author(
             name=data["name"],
             bio=data.get("bio", "")
         )
         session.add(new_author)
         session.commit()
-        session.close()
+        bump("authors")
+        suggest.suggest_index.add("author", new_author.id, new_author.name)
         return jsonify({"message": "Author added successfully!"})
     
     @app.route("/authors/<int:author_id>", methods=["PUT"])
     @token_required
     def update_author(author_id):
         data = request.get_json()
-        session = SessionLocal()
+        session = get_session()
         author = session.query(Author).get(author_id)
         
         if not author:
-            session.close()
             return jsonify({"message": "Author not found"}), 404
         
         if "name" in data:
@@ -190,73 +370,78 @@ def register_routes(app):
             author.bio = data["bio"]
         
         session.commit()
-        session.close()
+        bump("authors")
+        search.book_index.invalidate()
+        suggest.suggest_index.add("author", author.id, author.name)
         return jsonify({"message": "Author updated successfully!"})
     
     @app.route("/authors/<int:author_id>", methods=["DELETE"])
     @token_required
     def delete_author(author_id):
-        session = SessionLocal()
-        author = session.query(Author).get(author_id)
-        if not author:
-           session.close()
+        session = get_session()
+
+        # one statement; books and their loans go through ON DELETE CASCADE
+        deleted = session.execute(
+            delete(Author).where(Author.id == author_id), execution_options={"synchronize_session": False}
+        ).rowcount
+        if not deleted:
            return jsonify({"message": "Author not found"}), 404
 
-        session.delete(author)
         session.commit()
-        session.close()
+        bump("authors", "books", "copies", "issued_books")
+        search.book_index.invalidate()
+        # the author's books went with it; rebuild rather than look them up
+        suggest.suggest_index.invalidate()
         return jsonify({"message": f"Author with id {author_id} deleted successfully!"})
     
 
     @app.route("/users", defaults={"user_id": None, "role": None}, methods=["GET"])
     @app.route("/users/<int:user_id>", defaults={"role": None}, methods=["GET"])
     @app.route("/users/role/<role>", defaults={"user_id": None}, methods=["GET"])
+    @read_only
     def search_users(user_id, role):
-        session = SessionLocal()
+        session = get_session()
 
-        query = session.query(User).options(joinedload(User.issued_books))
+        criteria = []
 
-        
         if user_id is not None:
-            query = query.filter(User.id == user_id)
+            criteria.append(User.id == user_id)
 
         
         role_param = role or request.args.get("role")
         if role_param:
             if role_param.lower() not in ("user", "admin"):
-                session.close()
                 return jsonify({"error": "Invalid role. Must be 'user' or 'admin'"}), 400
-            query = query.filter(User.role == role_param.lower())
+            criteria.append(User.role == role_param.lower())
 
        
         name = request.args.get("name")
         email = request.args.get("email")
 
         if name:
-            query = query.filter(User.name.ilike(f"%{name}%"))
+            criteria.append(User.name.ilike(f"%{name}%"))
         if email:
-            query = query.filter(User.email.ilike(f"%{email}%"))
+            criteria.append(User.email.ilike(f"%{email}%"))
 
-        users = query.all()
+        users = session.execute(schemas.USER.select().where(*criteria).order_by(User.id)).all()
 
         if not users:
-            session.close()
             return jsonify({"message": "No users found"}), 404
 
-        result = [
-            {
-                "id": u.id,
-                "name": u.name,
-                "email": u.email,
-                "role": u.role,
-                "issued_books": [
-                    {"id": b.id, "book_name": b.book_name} for b in u.issued_books
-                ]
-            }
-            for u in users
-        ]
+        # every matching user's loans in one more query, instead of a join per user
+        loans = {}
+        matching = select(User.id).where(*criteria)
+        for row in session.execute(
+            schemas.USER_LOAN.select(IssuedBook.user_id)
+            .where(IssuedBook.user_id.in_(matching))
+            .order_by(IssuedBook.id)
+        ):
+            loans.setdefault(row[0], []).append(schemas.USER_LOAN.dump(row[1:]))
+
+        result = schemas.USER.dump_all(users)
+        for user in result:
+            user["issued_books"] = loans.get(user["id"], [])
 
-        session.close()
         return jsonify(result)
 
 
@@ -264,16 +449,20 @@ def register_routes(app):
     @app.route("/users/<int:user_id>", methods=["DELETE"])
     @token_required
     def delete_user(user_id):
-        session = SessionLocal()
-
-        user = session.get(User, user_id)
-        if not user:
-            session.close()
+        session = get_session()
+
+        # the user's loans first, so copies still on loan go back on the shelf
+        circulation.delete_loans(session, IssuedBook.user_id == user_id)
+        deleted = session.execute(
+            delete(User).where(User.id == user_id), execution_options={"synchronize_session": False}
+        ).rowcount
+        if not deleted:
+            session.rollback()
             return jsonify({"message": "User not found"}), 404
 
-        session.delete(user)
         session.commit()
-        session.close()
+        bump("users", "issued_books", "books", "copies")
+        invalidate_user(user_id)
 
         return jsonify({"message": f"User with id {user_id} deleted successfully!"})
     
@@ -283,20 +472,21 @@ def register_routes(app):
     @token_required
     def add_user():
         data = request.get_json()
-        session = SessionLocal()
+        session = get_session()
         name = data.get("name")
         email = data.get("email")
         password = data.get("password")
         role = data.get("role", "user").lower()
 
         if not name or not email or not password:
-            session.close()
             return jsonify({"error": "Name, email and password are required"}), 400
         if role not in ("user", "admin"):
-            session.close()
             return jsonify({"error": "Invalid role. Must be 'user' or 'admin'"}), 400
 
-        pw_hash = hash_password(password)
+        try:
+            pw_hash = kdf_pool.run(hash_password, password)
+        except HasherBusy:
+            return hasher_busy_response()
         new_user = User(name=name, email=email, password=pw_hash, role=role)
 
         session.add(new_user)
@@ -304,117 +494,190 @@ def register_routes(app):
             session.commit()
         except IntegrityError:
             session.rollback()
-            session.close()
             return jsonify({"error": "Email already exists"}), 400
 
-        session.close()
+        bump("users")
         return jsonify({"message": "User added successfully!"})
 
 
+    @app.route("/stats", methods=["GET"])
+    @token_required
+    @cached_response(*stats.STATS_TABLES)
+    @read_only
+    def get_stats():
+        top = request.args.get("top", "")
+        top = min(int(top), stats.MAX_TOP) if top.isdigit() and int(top) > 0 else stats.DEFAULT_TOP
+        return jsonify(stats.get_stats(get_session(), top))
+
+
     @app.route("/issued_books", methods=["GET"])
     @token_required
+    @read_only
     def list_issued_books():
-        session = SessionLocal()
-        query = session.query(IssuedBook).options(joinedload(IssuedBook.book), joinedload(IssuedBook.user))
+        session = get_session()
+        stmt = schemas.ISSUED_BOOK.select().where(*issued_book_filters(request.args))
+        issued = session.execute(stmt.order_by(IssuedBook.id).execution_options(yield_per=YIELD_PER))
+        return stream_json_array(
+            issued,
+            schemas.ISSUED_BOOK.dump,
+            empty_response=(jsonify({"message": "No issued books found"}), 404),
+        )
 
-        user_id = request.args.get("user_id")
-        book_id = request.args.get("book_id")
-        status = request.args.get("status")
 
+    @app.route("/export/books", methods=["GET"])
+    @token_required
+    @read_only
+    def export_books():
+        # ?format=csv|ndjson plus the search filters ?title=&category=&status=&author=
+        fmt, gzip, error = exports.export_args()
+        if error:
+            return jsonify({"error": error}), 400
+        stmt = search.apply_filters(
+            schemas.BOOK.select(),
+            request.args.get("title"), request.args.get("category"),
+            request.args.get("status"), request.args.get("author"),
+        ).order_by(Book.id)
+        rows = exports.stream_statement(get_session(), stmt)
+        return exports.export_response(rows, schemas.BOOK, fmt, gzip, "books")
+
+
+    @app.route("/export/issued_books", methods=["GET"])
+    @token_required
+    @read_only
+    def export_issued_books():
+        # ?format=csv|ndjson plus the /issued_books filters ?user_id=&book_id=&status=
+        fmt, gzip, error = exports.export_args()
+        if error:
+            return jsonify({"error": error}), 400
+        stmt = schemas.ISSUED_BOOK.select().where(*issued_book_filters(request.args)).order_by(IssuedBook.id)
+        rows = exports.stream_statement(get_session(), stmt)
+        return exports.export_response(rows, schemas.ISSUED_BOOK, fmt, gzip, "issued_books")
+
+
+    @app.route("/issued_books/overdue", methods=["GET"])
+    @token_required
+    @read_only
+    def list_overdue_books():
+        # open loans past due, most overdue first; ?user_id= narrows to one patron
+        session = get_session()
+        stmt = schemas.ISSUED_BOOK.select().where(*circulation.overdue_criteria())
+        user_id = request.args.get("user_id")
         if user_id and user_id.isdigit():
-            query = query.filter(IssuedBook.user_id == int(user_id))
-        if book_id and book_id.isdigit():
-            query = query.filter(IssuedBook.book_id == int(book_id))
-        if status:
-            query = query.filter(IssuedBook.status.ilike(f"%{status}%"))
+            stmt = stmt.where(IssuedBook.user_id == int(user_id))
+        overdue = session.execute(
+            stmt.order_by(IssuedBook.due_at, IssuedBook.id).execution_options(yield_per=YIELD_PER)
+        )
+        return stream_json_array(overdue, schemas.ISSUED_BOOK.dump)
 
-        issued = query.all()
-        if not issued:
-            session.close()
-            return jsonify({"message": "No issued books found"}), 404
-
-        result = [
-            {
-                "id": i.id,
-                "book_id": i.book_id,
-                "book_title": i.book.title if i.book else None,
-                "user_id": i.user_id,
-                "user_name": i.user.name if i.user else None,
-                "status": i.status
-            }
-            for i in issued
-        ]
-        session.close()
-        return jsonify(result)
+
+    @app.route("/issued_books/overdue/summary", methods=["GET"])
+    @token_required
+    def overdue_summary():
+        # last background sweep; ?refresh=1 runs one now
+        if request.args.get("refresh") == "1":
+            overdue.sweeper.sweep()
+        return jsonify(overdue.sweeper.stats())
 
 
     @app.route("/issued_books/<int:issue_id>", methods=["GET"])
     @token_required
+    @read_only
     def get_issued_book(issue_id):
-        session = SessionLocal()
-        issued = session.query(IssuedBook).options(joinedload(IssuedBook.book), joinedload(IssuedBook.user)).get(issue_id)
+        session = get_session()
+        issued = session.execute(
+            schemas.ISSUED_BOOK.select().where(IssuedBook.id == issue_id)
+        ).first()
         if not issued:
-            session.close()
             return jsonify({"message": "Issued record not found"}), 404
 
-        result = {
-            "id": issued.id,
-            "book_id": issued.book_id,
-            "book_title": issued.book.title if issued.book else None,
-            "user_id": issued.user_id,
-            "user_name": issued.user.name if issued.user else None,
-            "status": issued.status
-        }
-        session.close()
-        return jsonify(result)
+        return schemas.json_response(schemas.ISSUED_BOOK.dump(issued))
 
 
     @app.route("/issued_books", methods=["POST"])
     @token_required
     def create_issued_book():
         data = request.get_json()
-        session = SessionLocal()
+        session = get_session()
         book_id = data.get("book_id")
         user_id = data.get("user_id")
 
         if not book_id or not user_id:
-            session.close()
             return jsonify({"error": "book_id and user_id are required"}), 400
 
-        book = session.get(Book, book_id)
-        user = session.get(User, user_id)
-        if not book:
-            session.close()
-            return jsonify({"error": "Book not found"}), 404
-        if not user:
-            session.close()
-            return jsonify({"error": "User not found"}), 404
-        if book.status != "available":
-            session.close()
-            return jsonify({"error": "Book not available"}), 400
-
-        issued = IssuedBook(book_id=book_id, user_id=user_id, status="issued")
-        book.status = "issued"
-        session.add(issued)
-        session.commit()
-
-        result = {"message": "Book issued successfully", "issued_id": issued.id}
-        session.close()
+        try:
+            days = circulation.loan_days(data.get("loan_days"))
+            issued = circulation.checkout(session, book_id, user_id, days)
+        except circulation.CirculationError as e:
+            return jsonify({"error": e.message}), e.status_code
+        bump("books", "copies", "issued_books")
+        recommend.similar_books.record_loan(issued.user_id, issued.book_id)
+
+        result = {"message": "Book issued successfully", "issued_id": issued.id,
+                  "copy_id": issued.copy_id, "due_at": issued.due_at.isoformat()}
         return jsonify(result), 201
 
 
+    @app.route("/issued_books/batch", methods=["POST"])
+    @token_required
+    def batch_issued_books():
+        # {"user_id": 1, "book_ids": [...]} checks books out,
+        # {"issue_ids": [...]} returns loans; one transaction either way.
+        data = request.get_json() or {}
+        session = get_session()
+        book_ids = data.get("book_ids")
+        issue_ids = data.get("issue_ids")
+        ids = book_ids if book_ids is not None else issue_ids
+
+        if not isinstance(ids, list) or not ids:
+            return jsonify({"error": "book_ids (with user_id) or issue_ids is required"}), 400
+        if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({"error": "ids must be integers"}), 400
+        if len(ids) > circulation.MAX_BATCH:
+            return jsonify({"error": f"At most {circulation.MAX_BATCH} items per batch"}), 400
+
+        try:
+            if book_ids is not None:
+                user_id = data.get("user_id")
+                if not user_id:
+                    return jsonify({"error": "user_id is required with book_ids"}), 400
+                days = circulation.loan_days(data.get("loan_days"))
+                results = circulation.checkout_many(session, user_id, book_ids, days)
+                for result in results:
+                    if "issued_id" in result:
+                        recommend.similar_books.record_loan(user_id, result["book_id"])
+            else:
+                results = circulation.return_many(session, issue_ids)
+        except circulation.CirculationError as e:
+            return jsonify({"error": e.message}), e.status_code
+        bump("books", "copies", "issued_books")
+
+        failed = sum(1 for r in results if "error" in r)
+        return jsonify({"succeeded": len(results) - failed, "failed": failed, "results": results})
+
+
+    @app.route("/issued_books/<int:issue_id>/return", methods=["POST"])
+    @token_required
+    def return_issued_book(issue_id):
+        session = get_session()
+        try:
+            book_id = circulation.return_book(session, issue_id)
+        except circulation.CirculationError as e:
+            return jsonify({"error": e.message}), e.status_code
+        bump("books", "copies", "issued_books")
+
+        return jsonify({"message": "Book returned successfully", "issued_id": issue_id, "book_id": book_id})
+
+
     @app.route("/issued_books/<int:issue_id>", methods=["DELETE"])
     @token_required
     def delete_issued_book(issue_id):
-        session = SessionLocal()
-        issued = session.query(IssuedBook).get(issue_id)
-        if not issued:
-            session.close()
+        session = get_session()
+        # an open loan's copy goes back on the shelf
+        if not circulation.delete_loans(session, IssuedBook.id == issue_id):
             return jsonify({"message": "Issued record not found"}), 404
 
-        session.delete(issued)
         session.commit()
-        session.close()
+        bump("issued_books", "books", "copies")
         return jsonify({"message": f"Issued record {issue_id} deleted"})
     
 
@@ -1,57 +1,95 @@
+"""
+Flask application factory.
+
+Importing this module only builds the app object: no database connection,
+no schema changes, no background threads. The engine is created on the
+first query (after the fork, under a preforking server), the overdue
+sweeper starts with the first request each process serves, and the schema
+is created or upgraded explicitly:
+
+    flask --app app init-db        (same as python migrate.py)
+
+Serve with gunicorn (gunicorn.conf.py enables --preload) or the dev server:
+
+    gunicorn app:app
+    python app.py
+"""
 from flask import Flask, jsonify
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
 import traceback
 
+import click
 
-from sqlalchemy.orm import sessionmaker
-from models import Author,Book,User, IssuedBook
-from database import engine
-from models import Base
+from database import init_app, SessionLocal
+import metrics
+import overdue
+from recommend import similar_books
+from suggest import suggest_index
 from api import register_routes
 from auth.token import register_auth_routes
 
 # load .env values into environment
 load_dotenv()
 
-app = Flask(__name__)
-# Enable CORS for all origins with proper configuration
-CORS(app, resources={r"/*": {"origins": "*", "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"], "allow_headers": ["Content-Type", "Authorization"]}})
-# Load SECRET_KEY from environment; fail fast if missing to avoid token mismatches
-secret = os.environ.get('SECRET_KEY')
-if not secret:
-    raise RuntimeError('SECRET_KEY is not set. Define it in .env or environment before starting the app.')
-app.config['SECRET_KEY'] = secret
-
-# Create all tables on startup
-try:
-    Base.metadata.create_all(bind=engine)
-    print("✓ Database tables created/verified successfully!")
-except Exception as e:
-    print(f"⚠ Warning: Could not create database tables: {str(e)}")
-    traceback.print_exc()
-
-# Global error handler for uncaught exceptions
-@app.errorhandler(500)
-def internal_error(error):
-    print(f"500 Error: {str(error)}")
-    traceback.print_exc()
-    return jsonify({"error": "Internal server error", "details": str(error)}), 500
-
-@app.errorhandler(Exception)
-def handle_exception(error):
-    print(f"Exception: {str(error)}")
-    traceback.print_exc()
-    return jsonify({"error": str(error)}), 500
-
-register_auth_routes(app)
-register_routes(app)
 
+def create_app(config=None):
+    app = Flask(__name__)
+    # Enable CORS for all origins with proper configuration
+    CORS(app, resources={r"/*": {"origins": "*", "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"], "allow_headers": ["Content-Type", "Authorization", "X-Primary-Until"], "expose_headers": ["X-Primary-Until"]}})
+    # Load SECRET_KEY from environment; fail fast if missing to avoid token mismatches
+    secret = os.environ.get('SECRET_KEY')
+    if not secret:
+        raise RuntimeError('SECRET_KEY is not set. Define it in .env or environment before starting the app.')
+    app.config['SECRET_KEY'] = secret
+    app.config.update(config or {})
 
-if __name__ == "__main__":
-    app.run(debug=True)
+    # One database session per request, closed when the request ends
+    init_app(app)
+    # Request counters/latency and GET /metrics
+    metrics.init_app(app)
+
+    # Global error handler for uncaught exceptions
+    @app.errorhandler(500)
+    def internal_error(error):
+        print(f"500 Error: {str(error)}")
+        traceback.print_exc()
+        return jsonify({"error": "Internal server error", "details": str(error)}), 500
 
+    @app.errorhandler(Exception)
+    def handle_exception(error):
+        metrics.record_exception(error)
+        print(f"Exception: {str(error)}")
+        traceback.print_exc()
+        return jsonify({"error": str(error)}), 500
 
+    # Background overdue-loan sweep (OVERDUE_SWEEP_INTERVAL, 0 disables)
+    # and the /suggest and /books/<id>/similar index builds. Started by the
+    # first request of each process rather than here, so a preloading
+    # gunicorn master never runs them and every worker gets its own.
+    @app.before_request
+    def start_background_tasks():
+        overdue.sweeper.start()
+        if not suggest_index.ready():
+            suggest_index.refresh(SessionLocal)
+        if not similar_books.ready():
+            similar_books.refresh(SessionLocal)
 
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create missing tables and apply pending migrations."""
+        from migrate import migrate
+        migrate()
+        click.echo("✓ Database tables created/verified successfully!")
 
+    register_auth_routes(app)
+    register_routes(app)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    app.run(debug=True)
@@ -0,0 +1,414 @@
+"""
+Async (ASGI) serving mode.
+
+    uvicorn asgi:app --workers 4
+
+Requests are routed with the Flask app's own URL map, so every route from
+register_routes and register_auth_routes is available. The read-heavy GET
+endpoints listed in ASYNC_VIEWS are served natively on an AsyncEngine
+(asyncpg for PostgreSQL, aiosqlite for SQLite): while they wait on the
+database the event loop keeps serving other requests instead of holding a
+thread. Every other route is passed to the Flask app through asgiref's
+WSGI adapter, which runs it in a thread as gunicorn would.
+
+Native views are counted in the same /metrics request series as the Flask
+views (http_requests_total, http_request_duration_seconds); their SQL is
+not in http_request_db_queries.
+
+Requires the packages in requirements-async.txt.
+"""
+import time
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+import jwt
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, parse_date, parse_etags
+from werkzeug.routing import RequestRedirect
+
+from app import app as flask_app
+import database
+import metrics
+from auth.token import token_user_id, cached_user, remember_user
+from models import Book, Author, User
+from pagination import page_args, FLUSH_ROWS, YIELD_PER
+import response_cache
+import schemas
+from schemas import dumps
+import search
+import stats
+
+
+def async_database_url(url):
+    """Map a sync DATABASE_URL onto the matching asyncio driver."""
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+
+def _async_engine_options(url):
+    options = {"pool_pre_ping": True}
+    if url.startswith("postgresql"):
+        connect_args = {"timeout": database.CONNECT_TIMEOUT}
+        if database.STATEMENT_TIMEOUT:
+            connect_args["server_settings"] = {"statement_timeout": str(database.STATEMENT_TIMEOUT)}
+        options.update(
+            pool_size=database.POOL_SIZE,
+            max_overflow=database.MAX_OVERFLOW,
+            pool_timeout=database.POOL_TIMEOUT,
+            pool_recycle=database.POOL_RECYCLE,
+            connect_args=connect_args,
+        )
+    return options
+
+
+AsyncSessionLocal = async_sessionmaker(expire_on_commit=False)
+
+# created in the worker on startup (or first request), never at import
+async_engine = None
+
+
+def get_async_engine():
+    global async_engine
+    if async_engine is None:
+        async_engine = create_async_engine(
+            async_database_url(database.db_url), **_async_engine_options(database.db_url)
+        )
+        # same statement timing / slow-query log as the sync engine
+        database.instrument(async_engine.sync_engine)
+        AsyncSessionLocal.configure(bind=async_engine)
+    return async_engine
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+# -- request / response helpers ----------------------------------------------
+
+class Request:
+    def __init__(self, scope):
+        self.path = scope["path"]
+        self.query_string = scope["query_string"].decode("latin-1")
+        self.args = dict(parse_qsl(self.query_string))
+        self.headers = {
+            k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]
+        }
+
+
+class Responder:
+    """Writes one HTTP response, optionally storing its body in the response cache."""
+
+    def __init__(self, send, validators=None, store_key=None):
+        self.send = send
+        self.validators = validators  # (etag, last_modified) or None
+        self.store_key = store_key
+        self._body = []
+        self._size = 0
+        self._status = 200
+
+    async def start(self, status, content_type=b"application/json"):
+        self._status = status
+        headers = [(b"content-type", content_type)] + CORS_HEADERS
+        if self.validators:
+            etag, last_modified = self.validators
+            headers += [
+                (b"etag", f'"{etag}"'.encode()),
+                (b"cache-control", b"private, no-cache"),
+            ]
+            if last_modified is not None:
+                headers.append((b"last-modified", http_date(last_modified).encode()))
+        await self.send({"type": "http.response.start", "status": status, "headers": headers})
+
+    async def write(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if self._body is not None and self.store_key:
+            self._size += len(chunk)
+            if self._size > response_cache.MAX_BODY_BYTES:
+                self._body = None
+            else:
+                self._body.append(chunk)
+        await self.send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+    async def finish(self):
+        await self.send({"type": "http.response.body", "body": b"", "more_body": False})
+        if self.store_key and self._body is not None and self._status in response_cache.CACHEABLE_STATUS:
+            response_cache.get_store().set(
+                self.store_key, (b"".join(self._body), self._status, "application/json")
+            )
+
+    async def json(self, data, status=200):
+        await self.start(status)
+        await self.write(dumps(data))
+        await self.finish()
+
+    async def json_array(self, rows, serialize, empty=None):
+        """Stream an async iterable of rows as a JSON array (see pagination.stream_json_array)."""
+        chunk = []
+        prefix = None
+        async for row in rows:
+            chunk.append(dumps(serialize(row)))
+            if len(chunk) >= FLUSH_ROWS:
+                if prefix is None:
+                    await self.start(200)
+                    prefix = b"["
+                await self.write(prefix + b",".join(chunk))
+                chunk = []
+                prefix = b","
+        if prefix is None:
+            if not chunk and empty is not None:
+                return await self.json(*empty)
+            await self.start(200)
+            prefix = b"["
+        if chunk or prefix == b"[":
+            await self.write(prefix + b",".join(chunk) + b"]")
+        else:
+            await self.write(b"]")
+        await self.finish()
+
+
+async def _conditional(request, send, tables):
+    """Handle ETag revalidation and cached bodies; returns a Responder or None if answered."""
+    if response_cache.CACHE_TTL <= 0:
+        return Responder(send)
+    key, etag, last_modified = response_cache.validators(request.path, request.query_string, tables)
+    inm = request.headers.get("if-none-match")
+    ims = request.headers.get("if-modified-since")
+    if response_cache.not_modified(parse_etags(inm) if inm else None,
+                                   parse_date(ims) if ims else None, etag, last_modified):
+        await send({"type": "http.response.start", "status": 304, "headers": CORS_HEADERS + [
+            (b"etag", f'"{etag}"'.encode()),
+            (b"cache-control", b"private, no-cache"),
+        ]})
+        await send({"type": "http.response.body", "body": b""})
+        return None
+
+    cached = response_cache.get_store().get(key)
+    if cached is not None:
+        body, status, _ = cached
+        responder = Responder(send, (etag, last_modified))
+        await responder.start(status)
+        await send({"type": "http.response.body", "body": body})
+        return None
+    return Responder(send, (etag, last_modified), store_key=key)
+
+
+async def _authenticate(request):
+    """Async counterpart of token_required; returns (current_user, error)."""
+    auth = request.headers.get("authorization", "")
+    token = auth.split(" ", 1)[1] if auth.startswith("Bearer ") else None
+    if not token:
+        return None, ({"error": "Token is missing"}, 401)
+    try:
+        user_id = token_user_id(token, flask_app.config["SECRET_KEY"])
+    except jwt.ExpiredSignatureError:
+        return None, ({"error": "Token expired"}, 401)
+    except jwt.InvalidTokenError as e:
+        return None, ({"error": f"Token is invalid: {str(e)}"}, 401)
+    if not user_id:
+        return None, ({"error": "Token is invalid"}, 401)
+
+    current_user = cached_user(user_id)
+    if current_user is None:
+        async with AsyncSessionLocal() as session:
+            user = await session.get(User, user_id)
+            if not user:
+                return None, ({"error": "Invalid token user"}, 401)
+            current_user = remember_user(user)
+    return current_user, None
+
+
+async def _rows(session, stmt):
+    result = await session.stream(stmt.execution_options(yield_per=YIELD_PER))
+    async for row in result:
+        yield row
+
+
+# -- native async views ------------------------------------------------------
+
+async def index(request, send):
+    await Responder(send).json({"message": "Flask app running successfully!"})
+
+
+async def get_authors(request, send):
+    responder = await _conditional(request, send, ("authors",))
+    if responder is None:
+        return
+    async with AsyncSessionLocal() as session:
+        stmt = schemas.AUTHOR.select().order_by(Author.id)
+        await responder.json_array(_rows(session, stmt), schemas.AUTHOR.dump)
+
+
+async def get_books(request, send):
+    _, error = await _authenticate(request)
+    if error:
+        return await Responder(send).json(*error)
+    limit, after, error = page_args(request.args.get("limit"), request.args.get("after"))
+    if error:
+        return await Responder(send).json({"error": error}, 400)
+    responder = await _conditional(request, send, ("books", "authors"))
+    if responder is None:
+        return
+
+    stmt = schemas.BOOK.select()
+    if after is not None:
+        stmt = stmt.where(Book.id > after)
+    stmt = stmt.order_by(Book.id).limit(limit)
+    async with AsyncSessionLocal() as session:
+        await responder.json_array(_rows(session, stmt), schemas.BOOK.dump)
+
+
+async def search_books(request, send, search_param=None, category=None, status=None, author=None):
+    limit, after, error = page_args(request.args.get("limit"), request.args.get("after"))
+    if error:
+        return await Responder(send).json({"error": error}, 400)
+    book_id, title, category, status, author = search.parse_search_path(
+        search_param, category, status, author
+    )
+    ranked, offset, error = search.page_order(
+        book_id, title, category, author, request.args.get("order"), request.args.get("offset"), after
+    )
+    if error:
+        return await Responder(send).json({"error": error}, 400)
+    responder = await _conditional(request, send, ("books", "authors"))
+    if responder is None:
+        return
+
+    empty = ({"message": "No books found"}, 404)
+
+    async with AsyncSessionLocal() as session:
+        stmt = search.apply_filters(schemas.BOOK_SEARCH.select(), title, category, status, author)
+
+        if ranked:
+            if get_async_engine().dialect.name != "postgresql":
+                rows = _indexed_search(session, title, category, status, author, limit, offset)
+                return await responder.json_array(rows, schemas.BOOK_SEARCH.dump, empty)
+            if await session.run_sync(search.has_pg_trgm):
+                stmt = stmt.order_by(*search.pg_rank_order(title, category, author))
+            else:
+                stmt = stmt.order_by(Book.id)
+            if offset:
+                stmt = stmt.offset(offset)
+        else:
+            if book_id is not None:
+                stmt = stmt.where(Book.id == book_id)
+            if after is not None:
+                stmt = stmt.where(Book.id > after)
+            stmt = stmt.order_by(Book.id)
+
+        await responder.json_array(_rows(session, stmt.limit(limit)), schemas.BOOK_SEARCH.dump, empty)
+
+
+async def _indexed_search(session, title, category, status, author, limit, offset=0):
+    terms = {"title": title, "category": category, "author": author}
+    ids = await session.run_sync(lambda s: search.book_index.search(s, terms))
+    if not status:
+        ids = ids[offset:]
+        offset = 0
+    skipped = 0
+    sent = 0
+    for start in range(0, len(ids), search.FETCH_CHUNK):
+        chunk = ids[start:start + search.FETCH_CHUNK]
+        stmt = search.apply_filters(schemas.BOOK_SEARCH.select().where(Book.id.in_(chunk)), status=status)
+        found = {row.id: row for row in (await session.execute(stmt)).all()}
+        for book_id in chunk:
+            if book_id in found:
+                if skipped < offset:
+                    skipped += 1
+                    continue
+                yield found[book_id]
+                sent += 1
+                if limit is not None and sent >= limit:
+                    return
+
+
+async def get_stats(request, send):
+    _, error = await _authenticate(request)
+    if error:
+        return await Responder(send).json(*error)
+    responder = await _conditional(request, send, stats.STATS_TABLES)
+    if responder is None:
+        return
+    top = request.args.get("top", "")
+    top = min(int(top), stats.MAX_TOP) if top.isdigit() and int(top) > 0 else stats.DEFAULT_TOP
+    async with AsyncSessionLocal() as session:
+        # the sync query code runs on the greenlet bridge; its IO is still awaited
+        result = await session.run_sync(lambda s: stats.get_stats(s, top))
+    await responder.json(result)
+
+
+# Flask endpoint name -> native async implementation (GET only)
+ASYNC_VIEWS = {
+    "index": index,
+    "get_authors": get_authors,
+    "get_books": get_books,
+    "search_books": search_books,
+    "get_stats": get_stats,
+}
+
+
+# -- application -------------------------------------------------------------
+
+class AsyncApp:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.fallback = WsgiToAsgi(wsgi_app)
+        self.adapter = wsgi_app.url_map.bind("localhost")
+
+    def match(self, scope):
+        """(view, rule, values) for a native async route, else (None, None, None)."""
+        if scope["method"] != "GET":
+            return None, None, None
+        try:
+            rule, values = self.adapter.match(scope["path"], method="GET", return_rule=True)
+        except (HTTPException, RequestRedirect):
+            return None, None, None
+        return ASYNC_VIEWS.get(rule.endpoint), rule, values
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        view, rule, values = self.match(scope) if scope["type"] == "http" else (None, None, None)
+        if view is None:
+            return await self.fallback(scope, receive, send)
+        get_async_engine()
+
+        began = time.perf_counter()
+        status = None
+
+        async def tracking_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await view(Request(scope), tracking_send, **values)
+        except Exception as e:
+            metrics.record_exception(e)
+            print(f"Exception: {str(e)}")
+            if status is not None:
+                raise
+            status = 500
+            await Responder(send).json({"error": str(e)}, 500)
+        finally:
+            # same series as the Flask views; the async engine's SQL is not counted
+            metrics.record_request("GET", rule.rule, status or 500, time.perf_counter() - began)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                get_async_engine()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if async_engine is not None:
+                    await async_engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = AsyncApp(flask_app)
@@ -0,0 +1,181 @@
+"""
+Password hashing.
+
+Hashes are produced with a memory-hard KDF from hashlib (scrypt by
+default, PBKDF2-SHA256 as an alternative) and store their parameters:
+
+    scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+    pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>
+
+so the cost can be raised later without breaking existing hashes.
+needs_rehash() tells the login view when a stored hash (including the old
+single-pass "salt$sha256" format) should be replaced.
+
+Hashing is deliberately slow, so callers run it through kdf_pool: a small
+bounded thread pool that keeps a burst of logins from taking every CPU on
+the worker and rejects work once its queue is full or a result takes longer
+than PASSWORD_HASH_TIMEOUT. Either way callers answer 503 with Retry-After.
+
+verify_unknown() checks against a fixed dummy hash when the account does
+not exist, so a failed login takes as long for an unknown email as for a
+known one.
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+KDF = os.environ.get("PASSWORD_KDF", "scrypt").lower()
+SCRYPT_N = int(os.environ.get("SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("SCRYPT_P", 1))
+PBKDF2_ITERATIONS = int(os.environ.get("PBKDF2_ITERATIONS", 600000))
+
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", 32))
+HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+# seconds a client is told to wait after a 503 from a busy pool
+RETRY_AFTER = 1
+
+DKLEN = 32
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+        maxmem=128 * n * r * p + 1024 * 1024, dklen=DKLEN,
+    )
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations, dklen=DKLEN)
+
+
+def hash_password(password: str) -> str:
+    """Hash a password with the configured KDF and a random salt."""
+    salt = secrets.token_bytes(16)
+    if KDF == "pbkdf2":
+        digest = _pbkdf2(password, salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(stored_value: str, provided_password: str) -> bool:
+    """Verify a provided password against any supported stored format."""
+    if not stored_value or "$" not in stored_value:
+        return False
+    parts = stored_value.split("$")
+    try:
+        if parts[0] == "scrypt" and len(parts) == 6:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            computed = _scrypt(provided_password, bytes.fromhex(parts[4]), n, r, p)
+            return hmac.compare_digest(computed.hex(), parts[5])
+        if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+            computed = _pbkdf2(provided_password, bytes.fromhex(parts[2]), int(parts[1]))
+            return hmac.compare_digest(computed.hex(), parts[3])
+    except ValueError:
+        return False
+
+    # legacy format: "<salt>$<sha256(salt + password)>"
+    salt, stored_digest = stored_value.split("$", 1)
+    computed = hashlib.sha256((salt + provided_password).encode("utf-8")).hexdigest()
+    return hmac.compare_digest(stored_digest, computed)
+
+
+def needs_rehash(stored_value: str) -> bool:
+    """True when the hash is not in the configured format and cost."""
+    parts = (stored_value or "").split("$")
+    if KDF == "pbkdf2":
+        return not (len(parts) == 4 and parts[0] == "pbkdf2_sha256"
+                    and parts[1] == str(PBKDF2_ITERATIONS))
+    return not (len(parts) == 6 and parts[0] == "scrypt"
+                and parts[1:4] == [str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)])
+
+
+_dummy_hash = None
+
+
+def dummy_hash() -> str:
+    """A hash in the configured format that no password is checked against for real."""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(secrets.token_hex(16))
+    return _dummy_hash
+
+
+def verify_unknown(provided_password: str) -> bool:
+    """Spend a real verification's time for an account that does not exist; always False."""
+    verify_password(dummy_hash(), provided_password)
+    return False
+
+
+class HasherBusy(Exception):
+    """The hashing pool is full or too slow; the client should retry later."""
+
+
+class KdfPool:
+    """Bounded thread pool for password hashing with queue-depth reporting."""
+
+    def __init__(self, workers=HASH_WORKERS, queue_size=HASH_QUEUE, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kdf")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _call(self, fn, args):
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+            self._slots.release()
+
+    def run(self, fn, *args):
+        """Run fn(*args) on the pool and wait for its result."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy("Too many password checks in progress")
+        with self._lock:
+            self._pending += 1
+        future = self._executor.submit(self._call, fn, args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            if future.cancel():
+                # still queued: it will never run, so give its slot back here
+                with self._lock:
+                    self._pending -= 1
+                self._slots.release()
+            with self._lock:
+                self.timed_out += 1
+            raise HasherBusy("Password check timed out") from None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self._pending,
+                "running": self._running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+
+kdf_pool = KdfPool()
@@ -1,7 +1,5 @@
 from datetime import datetime, timedelta
-import hashlib
-import hmac
-import secrets
+import os
 import time
 import traceback
 
@@ -9,28 +7,26 @@ from flask import jsonify, request, g, current_app
 from functools import wraps
 import jwt
 from sqlalchemy.exc import IntegrityError, OperationalError
-from sqlalchemy.orm import sessionmaker
 
-from database import engine
+from database import get_session
 from models import User
-
-SessionLocal = sessionmaker(bind=engine)
-
-
-def hash_password(password: str) -> str:
-    """Hash a password using SHA-256 with a per-user salt."""
-    salt = secrets.token_hex(16)
-    digest = hashlib.sha256((salt + password).encode("utf-8")).hexdigest()
-    return f"{salt}${digest}"
-
-
-def verify_password(stored_value: str, provided_password: str) -> bool:
-    """Verify a provided password against the stored salt+hash."""
-    if not stored_value or "$" not in stored_value:
-        return False
-    salt, stored_digest = stored_value.split("$", 1)
-    computed = hashlib.sha256((salt + provided_password).encode("utf-8")).hexdigest()
-    return hmac.compare_digest(stored_digest, computed)
+from auth.cache import TTLCache
+from auth.passwords import hash_password, verify_password, needs_rehash, verify_unknown, kdf_pool, HasherBusy, RETRY_AFTER
+from table_versions import bump
+
+# Decoded tokens (token -> user_id) and user records (user_id -> g.current_user)
+# are cached so an authenticated read does not need a database round trip.
+# The caches are per process, so writes always re-read the user: a user
+# deleted or demoted through another worker cannot change anything, and
+# can read for at most USER_CACHE_TTL.
+_token_cache = TTLCache(
+    maxsize=int(os.environ.get("TOKEN_CACHE_SIZE", 4096)),
+    ttl=float(os.environ.get("TOKEN_CACHE_TTL", 300)),
+)
+_user_cache = TTLCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("USER_CACHE_TTL", 60)),
+)
 
 
 def generate_access_token(user, secret: str) -> str:
@@ -47,6 +43,70 @@ def generate_access_token(user, secret: str) -> str:
     return token
 
 
+def invalidate_user(user_id):
+    """Drop a cached user record after it was deleted or its role changed.
+
+    Only this process's cache; other workers find out on the user's next
+    write, or when their entry expires.
+    """
+    _user_cache.pop(user_id)
+
+
+def hasher_busy_response():
+    return jsonify({"error": "Server busy, please try again"}), 503, {"Retry-After": str(RETRY_AFTER)}
+
+
+def cache_stats():
+    return {"tokens": _token_cache.stats(), "users": _user_cache.stats()}
+
+
+def token_user_id(token, secret):
+    """user_id carried by a valid token (None if it has none).
+
+    Raises jwt.ExpiredSignatureError / jwt.InvalidTokenError like jwt.decode.
+    """
+    user_id = _token_cache.get(token)
+    if user_id is None:
+        data = jwt.decode(token, secret, algorithms=["HS256"])
+        user_id = data.get("user_id")
+        if not user_id:
+            return None
+        # never keep a token around past its own expiry
+        _token_cache.set(token, user_id, ttl=data.get("exp", 0) - time.time())
+    return user_id
+
+
+def cached_user(user_id):
+    return _user_cache.get(user_id)
+
+
+def remember_user(user):
+    """Cache and return the g.current_user dict for a User row."""
+    current_user = {
+        "id": user.id,
+        "name": user.name,
+        "email": user.email,
+        "role": user.role,
+    }
+    _user_cache.set(user.id, current_user)
+    return current_user
+
+
+def _load_current_user(user_id, fresh=False):
+    """g.current_user for user_id; fresh skips the cache and reads the database."""
+    if not fresh:
+        current_user = cached_user(user_id)
+        if current_user is not None:
+            return current_user
+
+    db = get_session()
+    user = db.get(User, user_id)
+    if not user:
+        _user_cache.pop(user_id)
+        return None
+    return remember_user(user)
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -59,23 +119,17 @@ def token_required(f):
         if not secret:
             return jsonify({"error": "Server configuration error: SECRET_KEY not found"}), 500
         try:
-            data = jwt.decode(token, secret, algorithms=["HS256"])
-            user_id = data.get("user_id")
+            user_id = token_user_id(token, secret)
             if not user_id:
                 return jsonify({"error": "Token is invalid"}), 401
 
-            db = SessionLocal()
-            user = db.get(User, user_id)
-            db.close()
-            if not user:
+            # writes check existence and role against the database
+            fresh = request.method not in ("GET", "HEAD", "OPTIONS")
+            current_user = _load_current_user(user_id, fresh=fresh)
+            if not current_user:
                 return jsonify({"error": "Invalid token user"}), 401
 
-            g.current_user = {
-                "id": user.id,
-                "name": user.name,
-                "email": user.email,
-                "role": user.role,
-            }
+            g.current_user = dict(current_user)
         except jwt.ExpiredSignatureError:
             return jsonify({"error": "Token expired"}), 401
         except jwt.InvalidTokenError as e:
@@ -96,7 +150,7 @@ def register_auth_routes(app):
             if not data:
                 return jsonify({"error": "No JSON data provided"}), 400
                 
-            session = SessionLocal()
+            session = get_session()
 
             name = data.get("name")
             email = data.get("email")
@@ -104,13 +158,14 @@ def register_auth_routes(app):
             role = data.get("role", "user").lower()
 
             if not name or not email or not password:
-                session.close()
                 return jsonify({"error": "Name, email and password are required"}), 400
             if role not in ("user", "admin"):
-                session.close()
                 return jsonify({"error": "Invalid role. Must be 'user' or 'admin'"}), 400
 
-            pw_hash = hash_password(password)
+            try:
+                pw_hash = kdf_pool.run(hash_password, password)
+            except HasherBusy:
+                return hasher_busy_response()
             new_user = User(name=name, email=email, password=pw_hash, role=role)
 
             session.add(new_user)
@@ -118,7 +173,6 @@ def register_auth_routes(app):
                 session.commit()
             except IntegrityError as e:
                 session.rollback()
-                session.close()
                 print(f"Integrity Error: {str(e)}")
                 # Check if it's email duplicate
                 if "unique" in str(e).lower() or "email" in str(e).lower():
@@ -126,12 +180,11 @@ def register_auth_routes(app):
                 return jsonify({"error": "Database constraint violation"}), 400
             except Exception as e:
                 session.rollback()
-                session.close()
                 print(f"Database error during signup: {str(e)}")
                 traceback.print_exc()
                 return jsonify({"error": f"Database error: {str(e)}"}), 500
 
-            session.close()
+            bump("users")
             return jsonify({"message": "Signup successful. Please login to get a token"}), 201
         except Exception as e:
             print(f"Unexpected error in signup: {str(e)}")
@@ -145,26 +198,32 @@ def register_auth_routes(app):
             if not data:
                 return jsonify({"error": "No JSON data provided"}), 400
             
-            session = SessionLocal()
+            session = get_session()
 
             email = data.get("email")
             password = data.get("password")
             if not email or not password:
-                session.close()
                 return jsonify({"error": "Email and password are required"}), 400
 
             user = session.query(User).filter(User.email == email).first()
-            if not user:
-                session.close()
-                return jsonify({"error": "Invalid credentials"}), 401
 
-            if not verify_password(user.password, password):
-                session.close()
-                return jsonify({"error": "Invalid credentials"}), 401
+            try:
+                if not user:
+                    # same work as a wrong password, so timing does not reveal
+                    # which emails have accounts
+                    kdf_pool.run(verify_unknown, password)
+                    return jsonify({"error": "Invalid credentials"}), 401
+                if not kdf_pool.run(verify_password, user.password, password):
+                    return jsonify({"error": "Invalid credentials"}), 401
+                # upgrade old-format or weaker hashes while we have the password
+                if needs_rehash(user.password):
+                    user.password = kdf_pool.run(hash_password, password)
+                    session.commit()
+            except HasherBusy:
+                return hasher_busy_response()
 
             secret = current_app.config.get("SECRET_KEY")
             if not secret:
-                session.close()
                 return jsonify({"error": "Server configuration error: SECRET_KEY not found"}), 500
             token = generate_access_token(user, secret)
 
@@ -179,7 +238,6 @@ def register_auth_routes(app):
                 },
             }
 
-            session.close()
             return jsonify(result)
         except Exception as e:
             print(f"Unexpected error in login: {str(e)}")
@@ -189,7 +247,11 @@ def register_auth_routes(app):
 __all__ = [
     "register_auth_routes",
     "token_required",
+    "invalidate_user",
+    "hasher_busy_response",
+    "cache_stats",
     "hash_password",
     "verify_password",
+    "needs_rehash",
     "generate_access_token",
 ]
@@ -0,0 +1,399 @@
+"""
+Reproducible API benchmark against a local database.
+
+Seeds a SQLite file (or a local PostgreSQL database) with a synthetic
+catalog, starts the Flask app in-process on a free port and drives a few
+fixed scenarios with concurrent keep-alive clients (see loadtest.py):
+
+    login         POST /login
+    search        GET  /books/search/<word>[/<category>]
+    issued_books  GET  /issued_books?user_id=<id>
+    checkout      POST /issued_books
+
+For each scenario it reports req/s, p50/p95/p99 latency and the number of
+SQL statements the app ran per request (counted with an engine event, so
+the app must run in this process).
+
+    python benchmark.py --seed --books 20000 --users 2000 --loans 10000
+    python benchmark.py --save baselines/main.json
+    python benchmark.py --compare baselines/main.json   # exit 1 on regression
+    python benchmark.py --startup                       # cold import time vs. budget
+
+The response and stats caches are disabled unless --cache is given, so the
+numbers measure the views rather than cache hits. Runs are seeded with
+--random-seed and are comparable only on the same machine and data size.
+
+--startup times `import app` in fresh interpreters instead. Importing the
+app must not open a database connection, so this is what every worker
+boot and every test import pays; it exits 1 when the median is over
+--startup-budget or when the import created an engine.
+"""
+import argparse
+from datetime import timedelta
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from loadtest import run_load, format_result
+
+DEFAULT_DB = "sqlite:///" + os.path.join(tempfile.gettempdir(), "library_benchmark.db")
+SCENARIOS = ("login", "search", "issued_books", "checkout")
+
+BENCH_EMAIL = "bench@example.com"
+BENCH_PASSWORD = "benchmark"
+
+WORDS = (
+    "river", "night", "garden", "empire", "shadow", "winter", "silent", "golden",
+    "storm", "island", "secret", "broken", "city", "ocean", "forest", "glass",
+    "iron", "crown", "letter", "journey", "memory", "paper", "stone", "summer",
+)
+CATEGORIES = (
+    "fiction", "history", "science", "poetry", "biography", "fantasy",
+    "mystery", "travel", "philosophy", "children",
+)
+SEED_CHUNK = 5000
+
+# cold `import app`, median of --startup-runs fresh interpreters
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", 750))
+_IMPORT_PROBE = (
+    "import time; started = time.perf_counter(); import app; "
+    "elapsed = (time.perf_counter() - started) * 1000; "
+    "import database; print(elapsed, database._engine is not None)"
+)
+
+
+class QueryCounter:
+    """Counts statements executed by an engine."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def _is_local(url):
+    if url.startswith("sqlite"):
+        return True
+    return urlsplit(url).hostname in ("localhost", "127.0.0.1", "::1", None)
+
+
+def _chunks(rows, size=SEED_CHUNK):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def seed(engine, books, authors, users, loans, rng):
+    """Drop and recreate the schema, then fill it with synthetic rows."""
+    from sqlalchemy import case, func, insert, select, update
+    from sqlalchemy.orm import Session
+    from auth.passwords import hash_password
+    from circulation import LOAN_DAYS
+    from models import Base, Book, Author, Copy, User, IssuedBook, utcnow
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    # one hash shared by every account: seeding should not take minutes of KDF time
+    pw_hash = hash_password(BENCH_PASSWORD)
+
+    with Session(engine) as session:
+        session.execute(insert(Author), [
+            {"name": f"{rng.choice(WORDS).title()} Author {i}", "bio": None}
+            for i in range(1, authors + 1)
+        ])
+        # most titles have a single copy, popular ones a few
+        copies = [rng.choice((1, 1, 1, 2, 3)) for _ in range(books)]
+        for chunk in _chunks([
+            {
+                "title": " ".join(rng.sample(WORDS, 3)).title() + f" {i}",
+                "category": rng.choice(CATEGORIES),
+                "author_id": rng.randint(1, authors),
+                "isbn": f"978{i:010d}",
+                "status": "available",
+                "total_copies": copies[i - 1],
+                "available_copies": copies[i - 1],
+            }
+            for i in range(1, books + 1)
+        ]):
+            session.execute(insert(Book), chunk)
+        for chunk in _chunks([
+            {"book_id": i, "status": "available"}
+            for i in range(1, books + 1) for _ in range(copies[i - 1])
+        ]):
+            session.execute(insert(Copy), chunk)
+        first_copy = dict(session.execute(
+            select(Copy.book_id, func.min(Copy.id)).group_by(Copy.book_id)
+        ).all())
+
+        user_rows = [{"name": "Bench Admin", "email": BENCH_EMAIL, "password": pw_hash, "role": "admin"}]
+        user_rows += [
+            {"name": f"Reader {i}", "email": f"reader{i}@example.com", "password": pw_hash, "role": "user"}
+            for i in range(2, users + 1)
+        ]
+        for chunk in _chunks(user_rows):
+            session.execute(insert(User), chunk)
+
+        # a quarter of the loans are still out (some overdue), the rest are history
+        now = utcnow()
+        active = rng.sample(range(1, books + 1), min(loans // 4, books // 2))
+        loan_rows = []
+        for book_id in active:
+            issued_at = now - timedelta(days=rng.randint(0, 30))
+            loan_rows.append({
+                "book_id": book_id, "copy_id": first_copy[book_id],
+                "user_id": rng.randint(1, users), "status": "issued",
+                "issued_at": issued_at, "due_at": issued_at + timedelta(days=LOAN_DAYS),
+            })
+        for _ in range(loans - len(active)):
+            issued_at = now - timedelta(days=rng.randint(30, 720))
+            loan_rows.append({
+                "book_id": rng.randint(1, books), "user_id": rng.randint(1, users), "status": "returned",
+                "issued_at": issued_at, "due_at": issued_at + timedelta(days=LOAN_DAYS),
+                "returned_at": issued_at + timedelta(days=rng.randint(1, LOAN_DAYS + 7)),
+            })
+        for chunk in _chunks(loan_rows):
+            session.execute(insert(IssuedBook), chunk)
+        for chunk in _chunks(active):
+            session.execute(
+                update(Copy).where(Copy.id.in_([first_copy[b] for b in chunk])).values(status="issued")
+            )
+            session.execute(update(Book).where(Book.id.in_(chunk)).values(
+                available_copies=Book.available_copies - 1,
+                status=case((Book.available_copies > 1, "available"), else_="issued"),
+            ))
+        session.commit()
+
+
+def _id_range(engine, column):
+    from sqlalchemy import func, select
+
+    with engine.connect() as conn:
+        low, high = conn.execute(select(func.min(column), func.max(column))).one()
+    if low is None:
+        raise SystemExit(f"{column} is empty; run with --seed first")
+    return low, high
+
+
+def scenarios(engine, rng, email, password):
+    """name -> request_factory(worker index) returning (method, path, body)."""
+    from models import Book, User
+
+    book_low, book_high = _id_range(engine, Book.id)
+    user_low, user_high = _id_range(engine, User.id)
+
+    def login(_):
+        return "POST", "/login", {"email": email, "password": password}
+
+    def search(_):
+        word = rng.choice(WORDS)
+        if rng.random() < 0.3:
+            return "GET", f"/books/search/{word}/{rng.choice(CATEGORIES)}", None
+        return "GET", f"/books/search/{word}", None
+
+    def issued_books(_):
+        return "GET", f"/issued_books?user_id={rng.randint(user_low, user_high)}", None
+
+    def checkout(_):
+        # books that are already out answer 400, which is part of the workload
+        return "POST", "/issued_books", {
+            "book_id": rng.randint(book_low, book_high),
+            "user_id": rng.randint(user_low, user_high),
+        }
+
+    return {"login": login, "search": search, "issued_books": issued_books, "checkout": checkout}
+
+
+def start_server(app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(args):
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-0123456789abcdef")
+    if not args.cache:
+        os.environ["RESPONSE_CACHE_TTL"] = "0"
+        os.environ["STATS_CACHE_TTL"] = "0"
+
+    from sqlalchemy import event
+    from database import get_engine
+
+    engine = get_engine()
+
+    rng = random.Random(args.random_seed)
+    if args.seed:
+        if not _is_local(args.database_url) and not args.force:
+            raise SystemExit("refusing to drop and reseed a non-local database (use --force)")
+        started = time.perf_counter()
+        seed(engine, args.books, args.authors, args.users, args.loans, rng)
+        print(f"seeded {args.books} books, {args.authors} authors, {args.users} users, "
+              f"{args.loans} loans in {time.perf_counter() - started:.1f}s")
+
+    from app import app
+    from loadtest import login
+
+    server = start_server(app)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    email, password = args.login.split(":", 1) if args.login else (BENCH_EMAIL, BENCH_PASSWORD)
+    headers = {"Authorization": f"Bearer {login(base_url, email, password)}"}
+
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    factories = scenarios(engine, rng, email, password)
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            if args.warmup:
+                run_load(base_url, "", args.concurrency, args.warmup,
+                         headers=headers, request_factory=factories[name])
+            counter.reset()
+            result = run_load(base_url, "", args.concurrency, args.duration,
+                              headers=headers, request_factory=factories[name])
+            queries = counter.reset()
+            result["url"] = name
+            result["queries_per_request"] = queries / result["requests"] if result["requests"] else 0.0
+            results[name] = result
+            print(f"{format_result(result)}  queries/req {result['queries_per_request']:.2f}")
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+        server.shutdown()
+
+    return {
+        "meta": {
+            "database": engine.dialect.name,
+            "books": args.books, "authors": args.authors,
+            "users": args.users, "loans": args.loans,
+            "concurrency": args.concurrency, "duration": args.duration,
+            "cache": args.cache, "python": platform.python_version(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def measure_startup(database_url, runs):
+    """Cold import times in ms (sorted) and whether any import created an engine."""
+    env = dict(os.environ, DATABASE_URL=database_url, OVERDUE_SWEEP_INTERVAL="0")
+    env.setdefault("SECRET_KEY", "benchmark-secret-key-0123456789abcdef")
+    backend = os.path.dirname(os.path.abspath(__file__))
+    times, connected = [], False
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", _IMPORT_PROBE], cwd=backend, env=env,
+                             capture_output=True, text=True, check=True)
+        elapsed, engine_created = out.stdout.split()[-2:]
+        times.append(float(elapsed))
+        connected = connected or engine_created == "True"
+    return sorted(times), connected
+
+
+def check_startup(args):
+    times, connected = measure_startup(args.database_url, args.startup_runs)
+    median = times[len(times) // 2]
+    print(f"import app: median {median:.0f} ms, min {times[0]:.0f} ms, max {times[-1]:.0f} ms "
+          f"over {len(times)} runs (budget {args.startup_budget:.0f} ms)")
+    failed = False
+    if connected:
+        print("FAIL import created a database engine; importing the app must not touch the database")
+        failed = True
+    if median > args.startup_budget:
+        print(f"FAIL startup over budget by {median - args.startup_budget:.0f} ms")
+        failed = True
+    return not failed
+
+
+def compare(baseline, current, tolerance):
+    """Print deltas against a saved run and return the regressed scenarios."""
+    regressions = []
+    for name, now in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        problems = []
+        if before["rps"] and now["rps"] < before["rps"] * (1 - tolerance):
+            problems.append(f"req/s {before['rps']:.1f} -> {now['rps']:.1f}")
+        if before["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            problems.append(f"p95 {before['p95_ms']:.1f} -> {now['p95_ms']:.1f} ms")
+        # statement counts are deterministic enough to compare almost exactly
+        if now["queries_per_request"] > before["queries_per_request"] + 0.05:
+            problems.append(f"queries/req {before['queries_per_request']:.2f} -> "
+                            f"{now['queries_per_request']:.2f}")
+        if problems:
+            regressions.append(name)
+            print(f"REGRESSION {name}: " + ", ".join(problems))
+        else:
+            print(f"ok         {name}: req/s {before['rps']:.1f} -> {now['rps']:.1f}, "
+                  f"p95 {before['p95_ms']:.1f} -> {now['p95_ms']:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the library API against a local database")
+    parser.add_argument("--database-url", default=os.environ.get("BENCHMARK_DATABASE_URL", DEFAULT_DB))
+    parser.add_argument("--seed", action="store_true", help="drop and reseed the database first")
+    parser.add_argument("--force", action="store_true", help="allow --seed on a non-local database")
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--authors", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--loans", type=int, default=10000)
+    parser.add_argument("--random-seed", type=int, default=42)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--cache", action="store_true", help="leave the response caches on")
+    parser.add_argument("--login", help="email:password to use instead of the seeded account")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against a JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative change in req/s and p95 (default 0.2)")
+    parser.add_argument("--startup", action="store_true", help="only measure cold `import app` time")
+    parser.add_argument("--startup-runs", type=int, default=7)
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET_MS,
+                        help=f"median import budget in ms (default {STARTUP_BUDGET_MS:.0f}, STARTUP_BUDGET_MS)")
+    args = parser.parse_args()
+
+    if args.startup:
+        sys.exit(0 if check_startup(args) else 1)
+
+    current = run(args)
+
+    if args.save:
+        directory = os.path.dirname(args.save)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Bulk book import used by POST /books/bulk.
+
+Records are read lazily from a JSON array, an NDJSON stream or a CSV stream
+and processed in batches: author names are resolved with one query per
+batch, ISBN conflicts are detected with one query per batch, and the valid
+rows are written with a single executemany INSERT (plus one for their
+copies). Bad rows are reported individually instead of failing the whole
+import.
+
+A "status" field (as in /export/books output) is ignored: status follows
+the copies, and an imported book has no loans, so its copies are shelved.
+"""
+import csv
+import io
+import json
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from circulation import MAX_COPIES
+from models import Book, Author, Copy
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 5000
+# per-row errors returned in the response; the count is always exact
+MAX_REPORTED_ERRORS = 1000
+
+
+class BulkImportError(ValueError):
+    """Raised when the upload itself cannot be read."""
+
+
+def iter_records(request):
+    """Yield (row_number, record) pairs from the request body.
+
+    record is a dict, or an error message string for rows that could not be
+    parsed. Row numbers start at 1 (for CSV, the first data row).
+    """
+    content_type = (request.mimetype or "").lower()
+
+    if content_type in ("application/x-ndjson", "application/jsonl", "application/json-seq"):
+        stream = io.TextIOWrapper(request.stream, encoding="utf-8")
+        row = 0
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            row += 1
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row, f"Invalid JSON: {e}"
+                continue
+            yield row, record if isinstance(record, dict) else "Each line must be a JSON object"
+
+    elif content_type in ("text/csv", "application/csv"):
+        stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+        reader = csv.DictReader(stream)
+        for row, record in enumerate(reader, start=1):
+            yield row, {k.strip(): (v.strip() if isinstance(v, str) else v)
+                        for k, v in record.items() if k}
+
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            raise BulkImportError("Body must be a JSON array, NDJSON or CSV")
+        for row, record in enumerate(data, start=1):
+            yield row, record if isinstance(record, dict) else "Each item must be a JSON object"
+
+
+def _batches(records, size):
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BookImporter:
+    def __init__(self, session, create_authors=False, batch_size=DEFAULT_BATCH_SIZE):
+        self.session = session
+        self.create_authors = create_authors
+        self.batch_size = batch_size
+        self.inserted = 0
+        self.failed = 0
+        self.authors_created = 0
+        self.errors = []
+        self._author_ids = {}      # lower(name) -> id
+        self._known_author_ids = set()
+        self._seen_isbns = set()
+
+    def error(self, row, message, isbn=None):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            entry = {"row": row, "error": message}
+            if isbn:
+                entry["isbn"] = isbn
+            self.errors.append(entry)
+
+    def run(self, records):
+        for batch in _batches(records, self.batch_size):
+            self._import_batch(batch)
+        return self.summary()
+
+    def summary(self):
+        return {
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "authors_created": self.authors_created,
+            "errors": sorted(self.errors, key=lambda e: e["row"]),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+    # -- per batch ---------------------------------------------------------
+
+    def _validate(self, batch):
+        valid = []
+        for row, record in batch:
+            if isinstance(record, str):
+                self.error(row, record)
+                continue
+
+            title = str(record.get("title") or "").strip()
+            category = str(record.get("category") or "").strip()
+            isbn = str(record.get("isbn") or "").strip()
+            author_id = record.get("author_id")
+            author_name = str(record.get("author_name") or "").strip()
+            copies = str(record.get("copies") or "1").strip()
+
+            if not title or not category or not isbn:
+                self.error(row, "title, category, and isbn are required", isbn)
+                continue
+            if author_id not in (None, ""):
+                try:
+                    author_id = int(author_id)
+                except (TypeError, ValueError):
+                    self.error(row, "author_id must be an integer", isbn)
+                    continue
+            else:
+                author_id = None
+            if author_id is None and not author_name:
+                self.error(row, "author_id or author_name is required", isbn)
+                continue
+            if not copies.isdigit() or not 1 <= int(copies) <= MAX_COPIES:
+                self.error(row, f"copies must be an integer between 1 and {MAX_COPIES}", isbn)
+                continue
+            if isbn in self._seen_isbns:
+                self.error(row, "Duplicate isbn in upload", isbn)
+                continue
+            self._seen_isbns.add(isbn)
+
+            valid.append({
+                "row": row,
+                "title": title,
+                "category": category,
+                "isbn": isbn,
+                "author_id": author_id,
+                "author_name": author_name,
+                "copies": int(copies),
+            })
+        return valid
+
+    def _resolve_authors(self, rows):
+        names = {r["author_name"].lower(): r["author_name"]
+                 for r in rows if r["author_id"] is None}
+        missing = [n for n in names if n not in self._author_ids]
+        if missing:
+            found = self.session.execute(
+                select(func.lower(Author.name), func.min(Author.id))
+                .where(func.lower(Author.name).in_(missing))
+                .group_by(func.lower(Author.name))
+            )
+            self._author_ids.update(dict(found.all()))
+
+            unknown = [n for n in missing if n not in self._author_ids]
+            if unknown and self.create_authors:
+                created = self.session.execute(
+                    insert(Author).returning(Author.id, Author.name),
+                    [{"name": names[n], "bio": ""} for n in unknown],
+                )
+                for author_id, name in created:
+                    self._author_ids[name.lower()] = author_id
+                    self._known_author_ids.add(author_id)
+                    self.authors_created += 1
+
+        ids = {r["author_id"] for r in rows if r["author_id"] is not None}
+        unchecked = ids - self._known_author_ids
+        if unchecked:
+            found = self.session.execute(select(Author.id).where(Author.id.in_(unchecked)))
+            self._known_author_ids.update(found.scalars())
+
+        resolved = []
+        for r in rows:
+            if r["author_id"] is None:
+                r["author_id"] = self._author_ids.get(r["author_name"].lower())
+                if r["author_id"] is None:
+                    self.error(r["row"], f"Author '{r['author_name']}' not found", r["isbn"])
+                    continue
+            elif r["author_id"] not in self._known_author_ids:
+                self.error(r["row"], f"Author {r['author_id']} not found", r["isbn"])
+                continue
+            resolved.append(r)
+        return resolved
+
+    def _drop_existing_isbns(self, rows):
+        if not rows:
+            return rows
+        existing = set(self.session.execute(
+            select(Book.isbn).where(Book.isbn.in_([r["isbn"] for r in rows]))
+        ).scalars())
+        kept = []
+        for r in rows:
+            if r["isbn"] in existing:
+                self.error(r["row"], "ISBN already exists", r["isbn"])
+            else:
+                kept.append(r)
+        return kept
+
+    def _import_batch(self, batch):
+        rows = self._validate(batch)
+        rows = self._resolve_authors(rows)
+        rows = self._drop_existing_isbns(rows)
+        values = [
+            {
+                **{k: r[k] for k in ("title", "category", "isbn", "author_id")},
+                "status": "available",
+                "total_copies": r["copies"],
+                "available_copies": r["copies"],
+            }
+            for r in rows
+        ]
+
+        if values:
+            try:
+                with self.session.begin_nested():
+                    inserted = self.session.execute(insert(Book).returning(Book.id, Book.isbn), values)
+                    self._shelve(rows, inserted.all())
+                self.inserted += len(values)
+            except IntegrityError:
+                # another writer raced us on an ISBN; isolate the bad rows
+                self._insert_one_by_one(rows, values)
+        self.session.commit()
+
+    def _insert_one_by_one(self, rows, values):
+        for r, v in zip(rows, values):
+            try:
+                with self.session.begin_nested():
+                    inserted = self.session.execute(insert(Book).returning(Book.id, Book.isbn), v)
+                    self._shelve([r], inserted.all())
+                self.inserted += 1
+            except IntegrityError:
+                self.error(r["row"], "ISBN already exists", r["isbn"])
+
+    def _shelve(self, rows, inserted):
+        """Insert the copies of newly inserted (id, isbn) books, all on the shelf."""
+        by_isbn = {r["isbn"]: r for r in rows}
+        copies = []
+        for book_id, isbn in inserted:
+            r = by_isbn[isbn]
+            copies += [{"book_id": book_id, "status": "available"}] * r["copies"]
+        if copies:
+            self.session.execute(insert(Copy), copies)
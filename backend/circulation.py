@@ -0,0 +1,367 @@
+"""
+Book checkout and return.
+
+Loans are made against copies (models.Copy). Checkout claims any free
+copy of the book and return puts the loan's copy back on the shelf. In the
+same transaction the book's available_copies counter is adjusted and its
+status kept as "available" while at least one copy is free, so listings
+never have to count copies.
+
+On PostgreSQL a free copy is picked with SELECT ... FOR UPDATE SKIP
+LOCKED: concurrent checkouts of a popular title each take a different copy
+instead of queuing on the same row. Other databases (SQLite, which
+serializes writers anyway) claim it with a conditional UPDATE (... WHERE
+status = 'available' RETURNING id). Either way a request that finds no
+free copy is told the book is not available, without a retry loop.
+
+Deleting loans goes through delete_loans(), so a loan deleted while open
+(directly or with its user) gives its copy back like a return would.
+"""
+from datetime import timedelta
+import os
+import threading
+
+from collections import Counter
+
+from sqlalchemy import case, delete, func, insert, select, text, update
+
+from models import Book, Copy, User, IssuedBook, utcnow
+
+# items accepted by one batch call
+MAX_BATCH = 500
+# copies added to a book by one request
+MAX_COPIES = 1000
+
+# default and maximum loan period; checkouts may ask for a shorter or longer one
+LOAN_DAYS = int(os.environ.get("LOAN_DAYS", 14))
+MAX_LOAN_DAYS = 365
+
+
+class CirculationError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class CirculationStats:
+    """Counters for checkout traffic; conflicts measure contention."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.returns = 0
+        self.conflicts = 0
+
+    def add(self, checkouts=0, returns=0, conflicts=0):
+        with self._lock:
+            self.checkouts += checkouts
+            self.returns += returns
+            self.conflicts += conflicts
+
+    def snapshot(self):
+        with self._lock:
+            return {"checkouts": self.checkouts, "returns": self.returns, "conflicts": self.conflicts}
+
+
+circulation_stats = CirculationStats()
+
+
+def loan_days(value):
+    """Validate an optional loan_days request field."""
+    if value is None:
+        return LOAN_DAYS
+    if not isinstance(value, int) or isinstance(value, bool) or not 1 <= value <= MAX_LOAN_DAYS:
+        raise CirculationError(f"loan_days must be an integer between 1 and {MAX_LOAN_DAYS}")
+    return value
+
+
+def copy_count(value, default=1):
+    """Validate an optional copies/count request field."""
+    if value is None:
+        return default
+    if not isinstance(value, int) or isinstance(value, bool) or not 1 <= value <= MAX_COPIES:
+        raise CirculationError(f"copies must be an integer between 1 and {MAX_COPIES}")
+    return value
+
+
+def overdue_criteria(now=None):
+    """Open loans past their due date; served by ix_issued_books_status_due_at."""
+    return (IssuedBook.status == "issued", IssuedBook.due_at < (now or utcnow()))
+
+
+# one free copy per requested book, rows that another transaction is
+# claiming are skipped rather than waited for
+_PG_CLAIM = text(
+    "SELECT c.id, c.book_id FROM unnest(CAST(:book_ids AS INTEGER[])) AS b(id) "
+    "CROSS JOIN LATERAL ("
+    "SELECT id, book_id FROM copies "
+    "WHERE copies.book_id = b.id AND copies.status = 'available' "
+    "LIMIT 1 FOR UPDATE SKIP LOCKED) AS c"
+)
+
+
+def _claim_copies(session, book_ids):
+    """Mark one free copy of each book issued. Returns {book_id: copy_id}.
+
+    Books without a free copy (or that do not exist) are left out.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        locked = session.execute(_PG_CLAIM, {"book_ids": list(book_ids)}).all()
+        if locked:
+            session.execute(
+                update(Copy).where(Copy.id.in_([copy_id for copy_id, _ in locked])).values(status="issued")
+            )
+    else:
+        first_free = (
+            select(func.min(Copy.id))
+            .where(Copy.book_id.in_(book_ids), Copy.status == "available")
+            .group_by(Copy.book_id)
+        )
+        locked = session.execute(
+            update(Copy)
+            .where(Copy.id.in_(first_free), Copy.status == "available")
+            .values(status="issued")
+            .returning(Copy.id, Copy.book_id)
+        ).all()
+
+    claimed = {book_id: copy_id for copy_id, book_id in locked}
+    if claimed:
+        # SET expressions see the old row, so "> 1" means a copy is left
+        session.execute(
+            update(Book)
+            .where(Book.id.in_(list(claimed)))
+            .values(
+                available_copies=Book.available_copies - 1,
+                status=case((Book.available_copies > 1, "available"), else_="issued"),
+            )
+        )
+    return claimed
+
+
+def _release_copies(session, loans):
+    """Put the copies of returned (book_id, copy_id) loans back on the shelf."""
+    copy_ids = [copy_id for _, copy_id in loans if copy_id is not None]
+    if not copy_ids:
+        return  # their copies were withdrawn while on loan
+    session.execute(update(Copy).where(Copy.id.in_(copy_ids)).values(status="available"))
+    per_book = Counter(book_id for book_id, copy_id in loans if copy_id is not None)
+    session.execute(
+        update(Book)
+        .where(Book.id.in_(list(per_book)))
+        .values(
+            available_copies=Book.available_copies + case(per_book, value=Book.id, else_=0),
+            status="available",
+        )
+    )
+
+
+def checkout(session, book_id, user_id, days=LOAN_DAYS):
+    """Issue a free copy of book_id to user_id for days and commit. Returns the new IssuedBook."""
+    if session.get(User, user_id) is None:
+        raise CirculationError("User not found", 404)
+
+    copy_id = _claim_copies(session, [book_id]).get(book_id)
+    if copy_id is None:
+        session.rollback()
+        if session.get(Book, book_id) is None:
+            raise CirculationError("Book not found", 404)
+        circulation_stats.add(conflicts=1)
+        raise CirculationError("Book not available", 400)
+
+    now = utcnow()
+    issued = IssuedBook(
+        book_id=book_id, copy_id=copy_id, user_id=user_id, status="issued",
+        issued_at=now, due_at=now + timedelta(days=days),
+    )
+    session.add(issued)
+    session.commit()
+    circulation_stats.add(checkouts=1)
+    return issued
+
+
+def return_book(session, issue_id):
+    """Mark a loan returned and put its copy back on the shelf, atomically."""
+    returned = session.execute(
+        update(IssuedBook)
+        .where(IssuedBook.id == issue_id, IssuedBook.status == "issued")
+        .values(status="returned", returned_at=utcnow())
+        .returning(IssuedBook.book_id, IssuedBook.copy_id)
+    ).first()
+    if returned is None:
+        session.rollback()
+        if session.get(IssuedBook, issue_id) is None:
+            raise CirculationError("Issued record not found", 404)
+        raise CirculationError("Book already returned", 400)
+
+    _release_copies(session, [returned])
+    session.commit()
+    circulation_stats.add(returns=1)
+    return returned.book_id
+
+
+def checkout_many(session, user_id, book_ids, days=LOAN_DAYS):
+    """Issue several books to one user in one transaction.
+
+    One copy of every book is claimed in a single statement, the loans are
+    inserted with one executemany, and the result lists every requested
+    book_id with either its new issued_id or an error. A book_id repeated
+    in the batch is issued once; its repeats get a "Duplicate" error.
+    """
+    requested = book_ids
+    book_ids = list(dict.fromkeys(book_ids))
+    if session.get(User, user_id) is None:
+        raise CirculationError("User not found", 404)
+
+    claimed = _claim_copies(session, book_ids)
+
+    issued = {}
+    if claimed:
+        now = utcnow()
+        due = now + timedelta(days=days)
+        rows = session.execute(
+            insert(IssuedBook).returning(IssuedBook.id, IssuedBook.book_id),
+            [{"book_id": book_id, "copy_id": claimed[book_id], "user_id": user_id,
+              "status": "issued", "issued_at": now, "due_at": due}
+             for book_id in book_ids if book_id in claimed],
+        )
+        issued = {book_id: issue_id for issue_id, book_id in rows}
+
+    unclaimed = [book_id for book_id in book_ids if book_id not in claimed]
+    existing = set()
+    if unclaimed:
+        existing = set(session.execute(
+            select(Book.id).where(Book.id.in_(unclaimed))
+        ).scalars())
+    session.commit()
+
+    results = []
+    answered = set()
+    for book_id in requested:
+        if book_id in answered:
+            results.append({"book_id": book_id, "error": "Duplicate book_id in batch"})
+            continue
+        answered.add(book_id)
+        if book_id in issued:
+            results.append({"book_id": book_id, "issued_id": issued[book_id]})
+        elif book_id in existing:
+            results.append({"book_id": book_id, "error": "Book not available"})
+        else:
+            results.append({"book_id": book_id, "error": "Book not found"})
+    circulation_stats.add(checkouts=len(issued), conflicts=len(existing))
+    return results
+
+
+def return_many(session, issue_ids):
+    """Return several loans in one transaction; one result per issue id.
+
+    An issue id repeated in the batch is returned once; its repeats get a
+    "Duplicate" error.
+    """
+    requested = issue_ids
+    issue_ids = list(dict.fromkeys(issue_ids))
+    rows = session.execute(
+        update(IssuedBook)
+        .where(IssuedBook.id.in_(issue_ids), IssuedBook.status == "issued")
+        .values(status="returned", returned_at=utcnow())
+        .returning(IssuedBook.id, IssuedBook.book_id, IssuedBook.copy_id)
+    ).all()
+    returned = {issue_id: book_id for issue_id, book_id, _ in rows}
+    _release_copies(session, [(book_id, copy_id) for _, book_id, copy_id in rows])
+
+    missing = [issue_id for issue_id in issue_ids if issue_id not in returned]
+    existing = set()
+    if missing:
+        existing = set(session.execute(
+            select(IssuedBook.id).where(IssuedBook.id.in_(missing))
+        ).scalars())
+    session.commit()
+
+    results = []
+    answered = set()
+    for issue_id in requested:
+        if issue_id in answered:
+            results.append({"issued_id": issue_id, "error": "Duplicate issued_id in batch"})
+            continue
+        answered.add(issue_id)
+        if issue_id in returned:
+            results.append({"issued_id": issue_id, "book_id": returned[issue_id]})
+        elif issue_id in existing:
+            results.append({"issued_id": issue_id, "error": "Book already returned"})
+        else:
+            results.append({"issued_id": issue_id, "error": "Issued record not found"})
+    circulation_stats.add(returns=len(returned))
+    return results
+
+
+def delete_loans(session, *criteria):
+    """Delete the loans matching criteria, shelving the copies of open ones.
+
+    Does not commit, so callers can delete the loans' owner in the same
+    transaction. Returns the number of loans deleted.
+    """
+    rows = session.execute(
+        delete(IssuedBook)
+        .where(*criteria)
+        .returning(IssuedBook.book_id, IssuedBook.copy_id, IssuedBook.status),
+        execution_options={"synchronize_session": False},
+    ).all()
+    _release_copies(session, [(book_id, copy_id) for book_id, copy_id, status in rows if status == "issued"])
+    return len(rows)
+
+
+def add_copies(session, book_id, count):
+    """Shelve count more copies of a book and commit. Returns the new copy ids."""
+    grown = session.execute(
+        update(Book)
+        .where(Book.id == book_id)
+        .values(
+            total_copies=Book.total_copies + count,
+            available_copies=Book.available_copies + count,
+            status="available",
+        )
+    ).rowcount
+    if not grown:
+        session.rollback()
+        raise CirculationError("Book not found", 404)
+    copy_ids = list(session.execute(
+        insert(Copy).returning(Copy.id),
+        [{"book_id": book_id, "status": "available"}] * count,
+    ).scalars())
+    session.commit()
+    return copy_ids
+
+
+def withdraw_copy(session, book_id, copy_id):
+    """Remove a copy that is on the shelf and commit.
+
+    Copies on loan are refused, and so is a book's last copy (delete the
+    book instead): "issued" means every copy is out, which a book without
+    copies could not honour.
+    """
+    # the book row is updated first, so concurrent withdrawals queue on it
+    # and cannot both take the last two copies
+    shrunk = session.execute(
+        update(Book)
+        .where(Book.id == book_id, Book.total_copies > 1)
+        .values(
+            total_copies=Book.total_copies - 1,
+            available_copies=Book.available_copies - 1,
+            status=case((Book.available_copies > 1, "available"), else_="issued"),
+        )
+    ).rowcount
+    removed = session.execute(
+        delete(Copy)
+        .where(Copy.id == copy_id, Copy.book_id == book_id, Copy.status == "available")
+        .returning(Copy.id),
+        execution_options={"synchronize_session": False},
+    ).first()
+    if not shrunk or removed is None:
+        session.rollback()
+        copy = session.get(Copy, copy_id)
+        if copy is None or copy.book_id != book_id:
+            raise CirculationError("Copy not found", 404)
+        if copy.status != "available":
+            raise CirculationError("Copy is on loan", 400)
+        raise CirculationError("Cannot withdraw the last copy of a book; delete the book instead", 400)
+    session.commit()
@@ -1,8 +1,21 @@
-from sqlalchemy import create_engine,Column, Integer, String,ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base , relationship
+from sqlalchemy import create_engine,Column, Integer, String,ForeignKey, event
+from sqlalchemy.orm import Session, sessionmaker, declarative_base , relationship
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+from flask import current_app, g, has_request_context, request
+from collections import Counter
 import os
+import re
+import threading
+import time
 from dotenv import load_dotenv
 
+from replicas import (
+    ReplicaSet, REPLICA_URLS, STICKY_SECONDS, PRIMARY_UNTIL_HEADER, PRIMARY_UNTIL_COOKIE,
+    sign_primary_until, primary_until,
+)
+
 load_dotenv()
 
 # Get database URL from environment variable, with fallback
@@ -15,16 +28,394 @@ db_url = os.environ.get(
 if db_url.startswith('postgres://'):
     db_url = db_url.replace('postgres://', 'postgresql://', 1)
 
-print(f"Connecting to database: {db_url.split('@')[1] if '@' in db_url else 'unknown'}")
+# Pool settings, overridable from the environment
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))         # seconds to wait for a free connection
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))          # seconds before a connection is replaced
+CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))      # seconds
+STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))  # 0 disables
+
+# Query instrumentation
+SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', 500))            # 0 disables the slow-query log
+# warn when one request runs the same statement shape more than this many times
+# (likely an N+1); on by default in development, 0 disables
+QUERY_REPEAT_LIMIT = int(os.environ.get(
+    'DB_QUERY_REPEAT_LIMIT',
+    10 if os.environ.get('FLASK_ENV') == 'development' else 0
+))
+
+
+class PoolWaitStats:
+    """How long requests wait to check a connection out of the pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "total_wait_seconds": self.total_wait,
+                "max_wait_seconds": self.max_wait,
+            }
+
+
+pool_wait_stats = PoolWaitStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records the time spent waiting for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            pool_wait_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_wait_stats.record(time.perf_counter() - start)
+        return conn
+
+
+def _engine_options(url):
+    options = {
+        'pool_pre_ping': True,  # Test connection before using it
+        'echo': False,
+    }
+    if url.startswith('sqlite'):
+        if ':memory:' not in url and url.rstrip('/') != 'sqlite:':
+            options.update(poolclass=TimedQueuePool, pool_size=POOL_SIZE,
+                           max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT)
+        return options
+
+    connect_args = {'connect_timeout': CONNECT_TIMEOUT}
+    if STATEMENT_TIMEOUT and url.startswith('postgresql'):
+        connect_args['options'] = f'-c statement_timeout={STATEMENT_TIMEOUT}'
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        connect_args=connect_args,
+    )
+    return options
+
+
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores ON DELETE CASCADE unless this is set on every connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+class RoutingSession(Session):
+    """Session that sends a read-only view's SELECTs to a read replica.
+
+    Everything else goes to the primary: writes (which also pin the rest
+    of the session to the primary, so a view reads its own writes),
+    SELECT ... FOR UPDATE, raw SQL, and every statement of a client that
+    wrote within the last few seconds (replicas.STICKY_SECONDS).
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif (
+            self.info.get('read_only')
+            and not self.info.get('wrote')
+            and isinstance(clause, Select)
+            and clause._for_update_arg is None
+        ):
+            replica = self._replica()
+            if replica is not None:
+                return replica.engine
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+    def _replica(self):
+        if has_request_context() and _pinned_to_primary():
+            return None
+        # one replica per session, so a request never mixes two replicas' lag
+        if 'replica' not in self.info:
+            self.info['replica'] = replica_set.pick()
+        if self.info['replica'] is not None and has_request_context():
+            g.replica_read = True
+        return self.info['replica']
+
+
+def _pinned_to_primary():
+    """True while the client's last write is within the read-your-writes window."""
+    if 'pinned_to_primary' not in g:
+        token = request.headers.get(PRIMARY_UNTIL_HEADER) or request.cookies.get(PRIMARY_UNTIL_COOKIE)
+        user = g.get('current_user')
+        g.pinned_to_primary = (
+            (token is not None and primary_until(token, current_app.config['SECRET_KEY']) > time.time())
+            or (user is not None and replica_set.is_sticky(user['id']))
+        )
+    return g.pinned_to_primary
+
+
+def served_by_replica():
+    """True when the current request read from a replica."""
+    return has_request_context() and g.get('replica_read', False)
+
+
+def pin_client_to_primary(response):
+    """After a write, hand the client its signed read-your-writes window."""
+    session = g.get('db_session')
+    if not replica_set or STICKY_SECONDS <= 0 or session is None or not session.info.get('wrote'):
+        return response
+    token = sign_primary_until(time.time() + STICKY_SECONDS, current_app.config['SECRET_KEY'])
+    response.headers[PRIMARY_UNTIL_HEADER] = token
+    response.set_cookie(PRIMARY_UNTIL_COOKIE, token, max_age=int(STICKY_SECONDS) + 1,
+                        httponly=True, samesite='Lax')
+    return response
+
+
+class LazySessionmaker(sessionmaker):
+    """sessionmaker that creates the engine when the first session is opened."""
+
+    def __call__(self, **local_kw):
+        get_engine()
+        return super().__call__(**local_kw)
+
+
+SessionLocal = LazySessionmaker(class_=RoutingSession)
+
+# The engine (and with it the DB driver import and the pool) is created on
+# first use rather than at import, so importing the app never touches the
+# database and a preforking server (gunicorn --preload) gives every worker
+# its own pool instead of sharing sockets opened in the master.
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """This process's Engine, created on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine(db_url)
+    return _engine
+
+
+def _create_engine(url):
+    print(f"Connecting to database: {url.split('@')[1] if '@' in url else 'unknown'}")
+    # Create engine with connection pool settings for better reliability
+    engine = create_engine(url, **_engine_options(url))
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', enable_sqlite_foreign_keys)
+    instrument(engine)
+    SessionLocal.configure(bind=engine)
+    return engine
+
+
+def _create_replica_engine(url):
+    print(f"Connecting to replica: {url.split('@')[1] if '@' in url else 'unknown'}")
+    engine = create_engine(url, **_engine_options(url))
+    instrument(engine)
+    return engine
+
+
+# read replicas from DATABASE_REPLICA_URLS (see replicas.py); empty -> primary only
+replica_set = ReplicaSet(REPLICA_URLS, _create_replica_engine)
+
+
+def _after_fork_in_child():
+    # connections pooled before the fork belong to the parent; drop them
+    # without closing the parent's sockets and let the child open its own
+    if _engine is not None:
+        _engine.dispose(close=False)
+    replica_set.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def __getattr__(name):
+    # `from database import engine` keeps working for scripts (migrate.py,
+    # benchmark.py); the app itself goes through get_engine()/SessionLocal
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# Create engine with connection pool settings for better reliability
-engine = create_engine(
-    db_url,
-    pool_pre_ping=True,  # Test connection before using it
-    connect_args={'connect_timeout': 10},  # 10 second timeout
-    echo=False
-)
 
 Base = declarative_base()
 
 
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """Statement shape: literals become ? and IN lists collapse to (?...)."""
+    statement = _SPACES.sub(" ", statement).strip()
+    statement = _LITERALS.sub("?", statement)
+    return _IN_LISTS.sub("(?...)", statement)
+
+
+class QueryLog:
+    """Statements run while handling one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        if QUERY_REPEAT_LIMIT:
+            self.shapes[normalize_sql(statement)] += 1
+
+    def repeated(self, limit):
+        return [(shape, n) for shape, n in self.shapes.most_common() if n > limit]
+
+
+def query_log():
+    """QueryLog for the current request, or None outside one."""
+    if not has_request_context():
+        return None
+    if 'query_log' not in g:
+        g.query_log = QueryLog()
+    return g.query_log
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    log = query_log()
+    if log is not None:
+        log.record(statement, duration)
+    if SLOW_QUERY_MS and duration * 1000 >= SLOW_QUERY_MS:
+        where = f" in {request.method} {request.path}" if has_request_context() else ""
+        print(f"Slow query ({duration * 1000:.1f} ms){where}: {normalize_sql(statement)}")
+
+
+def _handle_error(exception_context):
+    # keep the start-time stack balanced when a statement fails
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+def instrument(engine):
+    """Attach the statement timing / slow-query listeners to an engine."""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def get_session():
+    """Session for the current request, opened on first use.
+
+    token_required and the view share it; it is closed (and rolled back if
+    the request failed) when the app context is torn down.
+    """
+    if 'db_session' not in g:
+        g.db_session = SessionLocal()
+        if replica_set and request.method in ('GET', 'HEAD') and _view_is_read_only():
+            g.db_session.info['read_only'] = True
+    return g.db_session
+
+
+def read_only(view):
+    """Mark a view whose SELECTs may be served by a read replica.
+
+    Only GET/HEAD requests are routed; the view's writes, if any, still go
+    to the primary. Works above or below token_required / cached_response
+    (functools.wraps copies the flag onto the wrappers).
+    """
+    view.read_only = True
+    return view
+
+
+def _view_is_read_only():
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'read_only', False)
+
+
+def detach_session():
+    """Take the request's session out of g so teardown leaves it open.
+
+    Used by streamed responses: Flask tears the app context down as soon as
+    the view returns, before the body is generated, so the stream closes the
+    session itself when it is done.
+    """
+    return g.pop('db_session', None)
+
+
+def close_session(exc=None):
+    session = g.pop('db_session', None)
+    if session is None:
+        return
+    if session.info.get('wrote') and 'current_user' in g:
+        # read-your-writes: this user reads from the primary for a while
+        replica_set.note_write(g.current_user['id'])
+    if exc is not None:
+        session.rollback()
+    session.close()
+
+
+def add_server_timing(response):
+    # streamed bodies run their queries later; only what ran so far is reported
+    log = g.get('query_log')
+    if log is not None:
+        response.headers.add(
+            'Server-Timing', f'db;dur={log.duration * 1000:.1f};desc="{log.count} queries"'
+        )
+    return response
+
+
+def report_repeated_queries(exc=None):
+    log = g.pop('query_log', None)
+    if log is None or not QUERY_REPEAT_LIMIT:
+        return
+    for shape, n in log.repeated(QUERY_REPEAT_LIMIT):
+        print(f"Possible N+1 in {request.method} {request.path}: ran {n} times: {shape}")
+
+
+def init_app(app):
+    app.after_request(add_server_timing)
+    app.after_request(pin_client_to_primary)
+    app.teardown_appcontext(close_session)
+    app.teardown_request(report_repeated_queries)
+
+
+def replica_stats():
+    return replica_set.stats()
+
+
+def pool_stats():
+    stats = pool_wait_stats.snapshot()
+    # no engine yet means no pool to report on; don't create one for /metrics
+    pool = _engine.pool if _engine is not None else None
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            idle=pool.checkedin(),
+        )
+    return stats
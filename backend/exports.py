@@ -0,0 +1,80 @@
+"""
+CSV / NDJSON export of the catalog and the loan history.
+
+Rows are read through a server-side cursor (stream_results, EXPORT_CHUNK
+rows per fetch), encoded a chunk at a time and, when the client accepts
+it, gzipped on the fly. Neither the worker nor the client ever needs the
+whole table in memory.
+"""
+import csv
+import io
+import zlib
+
+from flask import request
+
+from pagination import streamed_response
+from schemas import dumps
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+DEFAULT_FORMAT = "ndjson"
+
+# rows fetched from the cursor / encoded per chunk
+EXPORT_CHUNK = 1000
+GZIP_LEVEL = 6
+
+
+def export_args():
+    """(format, gzip, error) from ?format= and Accept-Encoding (?gzip=0 opts out)."""
+    fmt = request.args.get("format", DEFAULT_FORMAT).lower()
+    if fmt not in FORMATS:
+        return None, False, f"format must be one of: {', '.join(sorted(FORMATS))}"
+    accepts_gzip = "gzip" in request.headers.get("Accept-Encoding", "").lower()
+    return fmt, accepts_gzip and request.args.get("gzip") != "0", None
+
+
+def stream_statement(session, stmt):
+    return session.execute(stmt.execution_options(stream_results=True, yield_per=EXPORT_CHUNK))
+
+
+def _csv_chunks(schema, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(schema.keys)
+    for partition in rows.partitions():
+        writer.writerows(partition)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _ndjson_chunks(schema, rows):
+    for partition in rows.partitions():
+        yield b"".join(dumps(schema.dump(row)) + b"\n" for row in partition)
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(rows, schema, fmt, gzip, name):
+    """Stream a result (from stream_statement) as an attachment."""
+    mimetype, extension = FORMATS[fmt]
+    chunks = _csv_chunks(schema, rows) if fmt == "csv" else _ndjson_chunks(schema, rows)
+    headers = {
+        "Content-Disposition": f'attachment; filename="{name}.{extension}"',
+        "Vary": "Accept-Encoding",
+    }
+    if gzip:
+        chunks = _gzip(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return streamed_response(chunks, content_type=mimetype, headers=headers)
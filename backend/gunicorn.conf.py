@@ -0,0 +1,27 @@
+"""
+gunicorn settings, read automatically when gunicorn starts in this directory:
+
+    gunicorn app:app
+
+The app is imported once in the master (preload_app) and the workers are
+forked from it, so they boot without re-importing Flask and SQLAlchemy and
+share those pages of memory. This is safe because importing app.py opens
+no database connection and starts no thread: each worker creates its own
+engine and pool on its first query and starts its own overdue sweeper on
+its first request.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+# GUNICORN_PRELOAD=0 imports the app in every worker instead
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def post_fork(server, worker):
+    # a preloaded master must not have opened a pool the workers could inherit
+    import database
+    if database._engine is not None:
+        server.log.warning("database engine was created before fork; worker %s drops its pooled connections", worker.pid)
@@ -0,0 +1,143 @@
+"""
+Concurrent HTTP load generator, used to compare the sync and async modes.
+
+Start both servers against the same database, e.g.
+
+    gunicorn -w 1 --threads 16 -b 127.0.0.1:5000 app:app
+    uvicorn asgi:app --workers 1 --port 5001
+
+then drive the same path on each:
+
+    python loadtest.py --path /books/search/all --login admin@example.com:secret \\
+        http://127.0.0.1:5000 http://127.0.0.1:5001
+
+Each client is a thread with its own keep-alive connection that sends
+requests back to back for --duration seconds.
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def login(base_url, email, password):
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    conn.request("POST", "/login", body=json.dumps({"email": email, "password": password}),
+                 headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    data = json.loads(response.read() or b"{}")
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"login failed ({response.status}): {data}")
+    return data["token"]
+
+
+def run_load(base_url, path, concurrency=16, duration=10.0, method="GET",
+             body=None, headers=None, request_factory=None):
+    """Hammer base_url + path and return latency/throughput numbers.
+
+    request_factory, if given, is called per request with the worker index
+    and returns (method, path, body) so scenarios can vary the requests.
+    """
+    parts = urlsplit(base_url)
+    headers = dict(headers or {})
+    json_headers = dict(headers, **{"Content-Type": "application/json"})
+
+    latencies = []
+    statuses = {}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        local = []
+        local_status = {}
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            req_method, req_path, req_body = (
+                request_factory(index) if request_factory else (method, path, body)
+            )
+            payload = json.dumps(req_body) if req_body is not None else None
+            start = time.perf_counter()
+            try:
+                conn.request(req_method, req_path, body=payload,
+                             headers=json_headers if payload is not None else headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+                continue
+            local.append(time.perf_counter() - start)
+            local_status[response.status] = local_status.get(response.status, 0) + 1
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+            for status, count in local_status.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "url": base_url + path,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "statuses": statuses,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+    }
+
+
+def format_result(result):
+    return (
+        f"{result['url']:<50} c={result['concurrency']:<4} "
+        f"{result['rps']:>9.1f} req/s  p50 {result['p50_ms']:>7.1f} ms  "
+        f"p95 {result['p95_ms']:>7.1f} ms  p99 {result['p99_ms']:>7.1f} ms  "
+        f"errors {result['errors']}  statuses {result['statuses']}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare API throughput across servers")
+    parser.add_argument("base_urls", nargs="+", help="e.g. http://127.0.0.1:5000")
+    parser.add_argument("--path", default="/books/search/all")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("--login", help="email:password used to obtain a bearer token")
+    args = parser.parse_args()
+
+    for base_url in args.base_urls:
+        headers = {}
+        if args.login:
+            email, password = args.login.split(":", 1)
+            headers["Authorization"] = f"Bearer {login(base_url, email, password)}"
+        print(format_result(run_load(base_url, args.path, args.concurrency, args.duration,
+                                     headers=headers)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Prometheus metrics for the Flask app, served at GET /metrics.
+
+Request counters and latency histograms are updated on every request, so
+they are sharded per thread: each thread only touches its own dict and
+the lock is taken once per thread (to register its shard) and when
+/metrics sums the shards. Histograms use fixed buckets and store one count
+per bucket, never the raw samples.
+
+Pool, cache, checkout and password-hashing numbers already live in their
+own modules; they are read when /metrics is scraped. Set METRICS_TOKEN to
+require "Authorization: Bearer <token>" on the endpoint.
+"""
+from bisect import bisect_left
+import hmac
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class _Sharded:
+    """Per-thread shards of {labels: value} merged on collection.
+
+    Shards of threads that have exited are folded into one retired dict,
+    so servers that start a thread per connection do not grow the list.
+    """
+
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard.items())
+        self._shards = live
+
+    def collect(self):
+        with self._lock:
+            self._retire()
+            totals = {}
+            self._merge(totals, self._retired.items())
+            for _, shard in self._shards:
+                # list() copies: the owning thread may add a key while we read
+                self._merge(totals, list(shard.items()))
+        return totals
+
+
+class CounterMetric(_Sharded):
+    def inc(self, labels=(), amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, into, items):
+        for labels, value in items:
+            into[labels] = into.get(labels, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class HistogramMetric(_Sharded):
+    def __init__(self, name, help_text, labelnames, buckets):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            # one slot per bucket, one for +Inf, then the sum
+            series = shard[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def _merge(self, into, items):
+        for labels, series in items:
+            merged = into.setdefault(labels, [0] * (len(self.buckets) + 2))
+            for i, value in enumerate(series):
+                merged[i] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = [_number(b) for b in self.buckets] + ["+Inf"]
+        for labels, series in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                le = _labels(self.labelnames + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            label_text = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _gauges(name, help_text, samples, kind="gauge"):
+    """Render [(label text, value)] read from another module."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{labels} {value}")
+    return lines
+
+
+requests_total = CounterMetric(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+request_duration = HistogramMetric(
+    "http_request_duration_seconds", "Time to build the response", ("method", "route"),
+    LATENCY_BUCKETS,
+)
+request_queries = HistogramMetric(
+    "http_request_db_queries", "SQL statements run per request", ("method", "route"),
+    QUERY_BUCKETS,
+)
+exceptions_total = CounterMetric(
+    "http_exceptions_total", "Unhandled exceptions by type", ("type",)
+)
+
+
+def _route():
+    rule = request.url_rule
+    # unmatched paths share one label so scanners cannot blow up cardinality
+    return rule.rule if rule is not None else "<unmatched>"
+
+
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(method, route, status, seconds, queries=None):
+    """Count one request; queries is None when the SQL was not counted."""
+    requests_total.inc((method, route, str(status)))
+    request_duration.observe(seconds, (method, route))
+    if queries is not None:
+        request_queries.observe(queries, (method, route))
+
+
+def _record(response):
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return response
+    log = g.get("query_log")
+    record_request(request.method, _route(), response.status_code,
+                   time.perf_counter() - start, log.count if log is not None else 0)
+    return response
+
+
+def record_exception(error):
+    exceptions_total.inc((type(error).__name__,))
+
+
+def _process_metrics():
+    # imported here so this module does not pull the app's modules in at import time
+    from auth.passwords import kdf_pool
+    from auth.token import cache_stats
+    from circulation import circulation_stats
+    from database import pool_stats, replica_stats
+    from overdue import sweeper
+    import response_cache
+
+    lines = []
+    pool = pool_stats()
+    for key in ("size", "checked_out", "overflow", "idle"):
+        if key in pool:
+            lines += _gauges(f"db_pool_{key}", f"Connection pool {key.replace('_', ' ')}", [("", pool[key])])
+    lines += _gauges("db_pool_checkouts_total", "Connections handed out by the pool",
+                     [("", pool["checkouts"])], "counter")
+    lines += _gauges("db_pool_timeouts_total", "Pool checkouts that timed out",
+                     [("", pool["timeouts"])], "counter")
+    lines += _gauges("db_pool_wait_seconds_total", "Time spent waiting for a pooled connection",
+                     [("", pool["total_wait_seconds"])], "counter")
+
+    replicas = replica_stats()
+    if replicas["replicas"]:
+        lines += _gauges("db_replica_healthy", "1 while the read replica is in rotation", [
+            (_labels(("replica",), (r["name"],)), int(r["healthy"])) for r in replicas["replicas"]
+        ])
+        lines += _gauges("db_replica_lag_seconds", "Replay lag seen by the last health check", [
+            (_labels(("replica",), (r["name"],)), r["lag_seconds"])
+            for r in replicas["replicas"] if r["lag_seconds"] is not None
+        ])
+        lines += _gauges("db_replica_reads_total", "Read-only requests routed to the replica", [
+            (_labels(("replica",), (r["name"],)), r["reads"]) for r in replicas["replicas"]
+        ], "counter")
+        lines += _gauges("db_replica_failures_total", "Failed health checks and dropped connections", [
+            (_labels(("replica",), (r["name"],)), r["failures"]) for r in replicas["replicas"]
+        ], "counter")
+        lines += _gauges("db_replica_fallbacks_total", "Read-only requests sent to the primary for lack of a healthy replica",
+                         [("", replicas["fallbacks"])], "counter")
+
+    caches = dict(cache_stats())
+    store = response_cache.get_store()
+    if hasattr(store, "stats"):
+        caches["responses"] = store.stats()
+    for kind in ("hits", "misses"):
+        lines += _gauges(f"cache_{kind}_total", f"Cache {kind}", [
+            (_labels(("cache",), (name,)), stats[kind]) for name, stats in sorted(caches.items())
+        ], "counter")
+    lines += _gauges("cache_entries", "Entries held in the cache", [
+        (_labels(("cache",), (name,)), stats["size"]) for name, stats in sorted(caches.items())
+    ])
+
+    circulation = circulation_stats.snapshot()
+    lines += _gauges("circulation_operations_total", "Checkouts and returns", [
+        (_labels(("operation",), ("checkout",)), circulation["checkouts"]),
+        (_labels(("operation",), ("return",)), circulation["returns"]),
+    ], "counter")
+    lines += _gauges("circulation_conflicts_total", "Checkouts that lost the race for a book",
+                     [("", circulation["conflicts"])], "counter")
+
+    sweep = sweeper.stats()
+    if sweep["last"] is not None:
+        lines += _gauges("overdue_loans", "Open loans past due at the last sweep",
+                         [("", sweep["last"]["overdue_loans"])])
+        lines += _gauges("overdue_sweep_duration_seconds", "Duration of the last overdue sweep",
+                         [("", sweep["last"]["duration_ms"] / 1000)])
+    lines += _gauges("overdue_sweeps_total", "Overdue sweeps run", [("", sweep["runs"])], "counter")
+    lines += _gauges("overdue_sweep_failures_total", "Overdue sweeps that failed",
+                     [("", sweep["failures"])], "counter")
+
+    hasher = kdf_pool.stats()
+    lines += _gauges("password_hash_queue_depth", "Password hashes waiting for a worker",
+                     [("", hasher["queue_depth"])])
+    lines += _gauges("password_hash_running", "Password hashes in progress", [("", hasher["running"])])
+    lines += _gauges("password_hash_completed_total", "Password hashes computed",
+                     [("", hasher["completed"])], "counter")
+    lines += _gauges("password_hash_rejected_total", "Password checks refused with 503",
+                     [("", hasher["rejected"])], "counter")
+    lines += _gauges("password_hash_timed_out_total", "Password checks that timed out (503)",
+                     [("", hasher["timed_out"])], "counter")
+    return lines
+
+
+def render():
+    lines = []
+    for metric in (requests_total, request_duration, request_queries, exceptions_total):
+        lines += metric.render()
+    lines += _process_metrics()
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    app.before_request(_start_timer)
+    app.after_request(_record)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        if METRICS_TOKEN:
+            supplied = request.headers.get("Authorization", "")
+            if not hmac.compare_digest(supplied, f"Bearer {METRICS_TOKEN}"):
+                return Response("unauthorized\n", status=401, mimetype="text/plain")
+        return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -1,25 +1,207 @@
 """
-Migration script to add password column to users table
-Run this once: python migrate.py
+Versioned schema migrations.
+
+Every migration has a version number and is recorded in the
+schema_migrations table once applied, so running this script again only
+applies what is new. Migrations are written to be idempotent (IF NOT
+EXISTS everywhere), so a run that stopped half way can simply be repeated.
+Indexes are built with CREATE INDEX CONCURRENTLY on PostgreSQL, which does
+not block writes to the table while the index is built.
+
+Usage:
+    python migrate.py          apply pending migrations
+    python migrate.py --list   show applied and pending versions
 """
+from datetime import timedelta
+import sys
+
 from sqlalchemy import text, inspect
-from database import engine
-
-def add_password_column():
-    with engine.connect() as connection:
-        # Check if password column already exists
-        inspector = inspect(engine)
-        columns = [col['name'] for col in inspector.get_columns('users')]
-        
-        if 'password' not in columns:
-            print("Adding password column to users table...")
-            connection.execute(text(
-                "ALTER TABLE users ADD COLUMN password VARCHAR(255) NOT NULL DEFAULT 'temp-password'"
-            ))
-            connection.commit()
-            print("✓ Password column added successfully!")
-        else:
-            print("✓ Password column already exists.")
+from database import get_engine, Base
+import models  # noqa: F401  (registers the tables on Base.metadata)
+from models import utcnow
+from circulation import LOAN_DAYS
+
+
+def is_postgres(connection):
+    return connection.dialect.name == "postgresql"
+
+
+def create_index(connection, name, table, columns, using=None):
+    """CREATE INDEX IF NOT EXISTS, online on PostgreSQL.
+
+    A CONCURRENTLY build that failed leaves an INVALID index behind which
+    IF NOT EXISTS would then skip, so such leftovers are dropped first.
+    """
+    if is_postgres(connection):
+        invalid = connection.execute(text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name}).first()
+        if invalid:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        method = f" USING {using}" if using else ""
+        connection.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}{method} ({columns})"
+        ))
+    else:
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+# -- migrations --------------------------------------------------------------
+
+def add_password_column(connection):
+    # Check if password column already exists
+    columns = [col['name'] for col in inspect(connection).get_columns('users')]
+    if 'password' not in columns:
+        connection.execute(text(
+            "ALTER TABLE users ADD COLUMN password VARCHAR(255) NOT NULL DEFAULT 'temp-password'"
+        ))
+
+
+def create_search_indexes(connection):
+    """pg_trgm GIN indexes let ILIKE '%term%' and similarity() use an index."""
+    if not is_postgres(connection):
+        return  # book search uses the in-process index
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    create_index(connection, "ix_books_title_trgm", "books", "title gin_trgm_ops", using="gin")
+    create_index(connection, "ix_books_category_trgm", "books", "category gin_trgm_ops", using="gin")
+    create_index(connection, "ix_authors_name_trgm", "authors", "name gin_trgm_ops", using="gin")
+
+
+def create_secondary_indexes(connection):
+    """Indexes for the foreign keys and filter columns used by the API."""
+    create_index(connection, "ix_books_author_id", "books", "author_id")
+    create_index(connection, "ix_books_status", "books", "status")
+    create_index(connection, "ix_books_category", "books", "category")
+    create_index(connection, "ix_users_role", "users", "role")
+    create_index(connection, "ix_issued_books_user_id_status", "issued_books", "user_id, status")
+    create_index(connection, "ix_issued_books_book_id_status", "issued_books", "book_id, status")
+    create_index(connection, "ix_issued_books_status", "issued_books", "status")
+
+
+def add_loan_dates(connection):
+    """issued_at / due_at / returned_at on issued_books, with range-scan indexes."""
+    columns = [col['name'] for col in inspect(connection).get_columns('issued_books')]
+    for name in ("issued_at", "due_at", "returned_at"):
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE issued_books ADD COLUMN {name} TIMESTAMP NULL"))
+
+    # the real dates of older loans are unknown: count them as issued now, so
+    # open loans fall due one loan period after the upgrade
+    now = utcnow()
+    connection.execute(
+        text("UPDATE issued_books SET issued_at = :now WHERE issued_at IS NULL"), {"now": now}
+    )
+    connection.execute(
+        text("UPDATE issued_books SET due_at = :due WHERE due_at IS NULL AND status = 'issued'"),
+        {"due": now + timedelta(days=LOAN_DAYS)},
+    )
+
+    create_index(connection, "ix_issued_books_status_due_at", "issued_books", "status, due_at")
+    create_index(connection, "ix_issued_books_issued_at", "issued_books", "issued_at")
+    create_index(connection, "ix_issued_books_returned_at", "issued_books", "returned_at")
+
+
+def add_copies(connection):
+    """copies table with one copy per existing book, plus the availability counters.
+
+    Each book's single copy mirrors its status and open loans are pointed
+    at it, so nothing changes for existing clients.
+    """
+    columns = [col['name'] for col in inspect(connection).get_columns('books')]
+    for name in ("total_copies", "available_copies"):
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE books ADD COLUMN {name} INTEGER NOT NULL DEFAULT 1"))
+    columns = [col['name'] for col in inspect(connection).get_columns('issued_books')]
+    if "copy_id" not in columns:
+        connection.execute(text(
+            "ALTER TABLE issued_books ADD COLUMN copy_id INTEGER NULL "
+            "REFERENCES copies (id) ON DELETE SET NULL"
+        ))
+
+    connection.execute(text(
+        "INSERT INTO copies (book_id, status) "
+        "SELECT id, CASE WHEN status = 'available' THEN 'available' ELSE 'issued' END FROM books "
+        "WHERE NOT EXISTS (SELECT 1 FROM copies WHERE copies.book_id = books.id)"
+    ))
+    create_index(connection, "ix_copies_book_id_status", "copies", "book_id, status")
+    create_index(connection, "ix_issued_books_copy_id", "issued_books", "copy_id")
+
+    # counted from the copies rather than assumed, so a repeated run is harmless
+    connection.execute(text(
+        "UPDATE books SET "
+        "total_copies = (SELECT COUNT(*) FROM copies WHERE copies.book_id = books.id), "
+        "available_copies = (SELECT COUNT(*) FROM copies "
+        "WHERE copies.book_id = books.id AND copies.status = 'available')"
+    ))
+    connection.execute(text(
+        "UPDATE issued_books SET copy_id = ("
+        "SELECT MIN(copies.id) FROM copies "
+        "WHERE copies.book_id = issued_books.book_id AND copies.status = 'issued') "
+        "WHERE status = 'issued' AND copy_id IS NULL"
+    ))
+
+
+MIGRATIONS = [
+    (1, "add users.password", add_password_column),
+    (2, "pg_trgm search indexes", create_search_indexes),
+    (3, "secondary indexes on foreign keys and filter columns", create_secondary_indexes),
+    (4, "loan issue/due/return dates", add_loan_dates),
+    (5, "book copies and availability counters", add_copies),
+]
+
+
+# -- runner ------------------------------------------------------------------
+
+def ensure_version_table(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR(200) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    ))
+
+
+def applied_versions(connection):
+    ensure_version_table(connection)
+    rows = connection.execute(text("SELECT version FROM schema_migrations"))
+    return {row[0] for row in rows}
+
+
+def migrate():
+    engine = get_engine()
+    # tables that do not exist yet are created from the models first
+    Base.metadata.create_all(bind=engine)
+
+    # AUTOCOMMIT: CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        done = applied_versions(connection)
+        pending = [m for m in MIGRATIONS if m[0] not in done]
+        if not pending:
+            print("✓ Database schema is up to date.")
+            return
+
+        for version, description, apply in pending:
+            print(f"Applying migration {version}: {description}...")
+            apply(connection)
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:v, :d)"),
+                {"v": version, "d": description},
+            )
+            print(f"✓ Migration {version} applied.")
+
+
+def list_migrations():
+    with get_engine().connect() as connection:
+        done = applied_versions(connection)
+        connection.commit()
+    for version, description, _ in MIGRATIONS:
+        state = "applied" if version in done else "pending"
+        print(f"{version:>4}  {state:<8} {description}")
+
 
 if __name__ == "__main__":
-    add_password_column()
+    if "--list" in sys.argv[1:]:
+        list_migrations()
+    else:
+        migrate()
@@ -1,10 +1,13 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, CheckConstraint
-from sqlalchemy.orm import relationship, sessionmaker
-from database import engine
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, CheckConstraint, Index
+from sqlalchemy.orm import relationship
 from database import Base
 
-Session = sessionmaker(bind=engine)
-session = Session()
+
+def utcnow():
+    """Naive UTC timestamp, the form all DateTime columns are stored in."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 class Book(Base):
@@ -12,21 +15,68 @@ class Book(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(150), nullable=False)
-    category = Column(String(100), nullable=False)
+    category = Column(String(100), nullable=False, index=True)
     author_id = Column(
         Integer,
         ForeignKey("authors.id", ondelete="CASCADE"),
-        nullable=False
+        nullable=False,
+        index=True
     )
 
     isbn = Column(String(50), unique=True)
 
+    # "available" while at least one copy is on the shelf, else "issued"
     status = Column(
         String(20),
         default="available",
-        nullable=False
+        nullable=False,
+        index=True
     )
+
+    # maintained by circulation.py on every checkout/return, so listings
+    # show availability without counting copies
+    total_copies = Column(Integer, nullable=False, default=1, server_default="1")
+    available_copies = Column(Integer, nullable=False, default=1, server_default="1")
+
     author = relationship("Author", back_populates="books")
+    copies = relationship(
+        "Copy",
+        back_populates="book",
+        cascade="all, delete",
+        passive_deletes=True
+    )
+
+
+class Copy(Base):
+    """One physical item of a book; loans are made against copies."""
+    __tablename__ = "copies"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    book_id = Column(
+        Integer,
+        ForeignKey("books.id", ondelete="CASCADE"),
+        nullable=False
+    )
+
+    barcode = Column(String(50), unique=True, nullable=True)
+
+    status = Column(
+        String(20),
+        default="available",
+        nullable=False
+    )
+
+    book = relationship("Book", back_populates="copies")
+
+    __table_args__ = (
+        CheckConstraint(
+            "status IN ('available', 'issued')",
+            name="check_copy_status"
+        ),
+        # checkout: first free copy of a book
+        Index("ix_copies_book_id_status", "book_id", "status"),
+    )
 
 
 class Author(Base):
@@ -38,7 +88,9 @@ class Author(Base):
     books = relationship(
         "Book",
         back_populates="author",
-        cascade="all, delete"
+        cascade="all, delete",
+        # the FK cascades in the database; never load the books just to delete them
+        passive_deletes=True
     )
 
 class User(Base):
@@ -56,13 +108,15 @@ class User(Base):
     role = Column(
         String(20),
         nullable=False,
-        default="user"
+        default="user",
+        index=True
     )
 
     issued_books = relationship(
         "IssuedBook",
         back_populates="user",
-        cascade="all, delete"
+        cascade="all, delete",
+        passive_deletes=True
     )
 
     __table_args__ = (
@@ -84,6 +138,14 @@ class IssuedBook(Base):
         nullable=False
     )
 
+    # NULL only for loans whose copy has since been withdrawn
+    copy_id = Column(
+        Integer,
+        ForeignKey("copies.id", ondelete="SET NULL"),
+        nullable=True,
+        index=True
+    )
+
     user_id = Column(
         Integer,
         ForeignKey("users.id", ondelete="CASCADE"),
@@ -96,7 +158,13 @@ class IssuedBook(Base):
         nullable=False
     )
 
+    # UTC; rows issued before these columns existed were backfilled by migrate.py
+    issued_at = Column(DateTime, nullable=True, default=utcnow)
+    due_at = Column(DateTime, nullable=True)
+    returned_at = Column(DateTime, nullable=True)
+
     book = relationship("Book")
+    copy = relationship("Copy")
     user = relationship("User", back_populates="issued_books")
 
     __table_args__ = (
@@ -104,4 +172,11 @@ class IssuedBook(Base):
             "status IN ('issued', 'returned')",
             name="check_issue_status"
         ),
+        Index("ix_issued_books_user_id_status", "user_id", "status"),
+        Index("ix_issued_books_book_id_status", "book_id", "status"),
+        Index("ix_issued_books_status", "status"),
+        # overdue scans: status = 'issued' AND due_at < now
+        Index("ix_issued_books_status_due_at", "status", "due_at"),
+        Index("ix_issued_books_issued_at", "issued_at"),
+        Index("ix_issued_books_returned_at", "returned_at"),
     )
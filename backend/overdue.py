@@ -0,0 +1,99 @@
+"""
+Periodic overdue-loan sweep.
+
+A daemon thread wakes every OVERDUE_SWEEP_INTERVAL seconds and counts the
+open loans past their due date with one aggregate range query on
+ix_issued_books_status_due_at (status = 'issued' AND due_at < now). The
+result of the last sweep, including how long it took, is kept for
+GET /issued_books/overdue/summary and /metrics.
+"""
+import os
+import threading
+import time
+import traceback
+
+from sqlalchemy import distinct, func, select
+
+from circulation import overdue_criteria
+from database import SessionLocal
+from models import IssuedBook, utcnow
+
+SWEEP_INTERVAL = float(os.environ.get("OVERDUE_SWEEP_INTERVAL", 300))  # seconds, 0 disables
+
+
+class OverdueSweeper:
+    def __init__(self, session_factory, interval=SWEEP_INTERVAL):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.runs = 0
+        self.failures = 0
+        self.last = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        """Run one sweep now and return its summary."""
+        now = utcnow()
+        start = time.perf_counter()
+        with self.session_factory() as session:
+            overdue, patrons, oldest = session.execute(
+                select(func.count(), func.count(distinct(IssuedBook.user_id)), func.min(IssuedBook.due_at))
+                .where(*overdue_criteria(now))
+            ).one()
+        duration = time.perf_counter() - start
+        summary = {
+            "ran_at": now.isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            "overdue_loans": overdue,
+            "patrons": patrons,
+            "oldest_due_at": oldest.isoformat() if oldest else None,
+        }
+        with self._lock:
+            self.runs += 1
+            self.last = summary
+        print(f"Overdue sweep: {overdue} loans, {patrons} patrons ({summary['duration_ms']:.1f} ms)")
+        return summary
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                print(f"Overdue sweep failed: {str(e)}")
+                traceback.print_exc()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the sweep thread unless it is disabled or already running.
+
+        Cheap enough to call on every request. After a fork the parent's
+        thread is not alive in the child, so each worker starts its own.
+        """
+        if self.interval <= 0 or self.running():
+            return
+        with self._lock:
+            if self.running():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="overdue-sweep", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "interval_seconds": self.interval,
+                "runs": self.runs,
+                "failures": self.failures,
+                "last": self.last,
+            }
+
+
+sweeper = OverdueSweeper(SessionLocal)
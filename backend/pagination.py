@@ -0,0 +1,107 @@
+"""
+Keyset pagination and streamed JSON responses for the list endpoints.
+
+Clients page with ?limit=<n>&after=<last id seen>. Rows are read from a
+server-side cursor and written out one by one, so a worker never holds the
+whole result set in memory.
+"""
+from flask import Response, jsonify, request, stream_with_context
+
+from database import detach_session
+from schemas import dumps
+
+# rows fetched per round trip from the server-side cursor
+YIELD_PER = 500
+MAX_LIMIT = 1000
+# rows encoded per chunk written to the client
+FLUSH_ROWS = 100
+
+
+def page_args(limit, after):
+    """Validate raw limit/after strings.
+
+    Returns (limit, after, error). limit and after are None when not
+    supplied; error is a message when either value is malformed.
+    """
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            return None, None, "limit must be a positive integer"
+        limit = min(int(limit), MAX_LIMIT)
+    if after is not None:
+        if not after.isdigit():
+            return None, None, "after must be a book id"
+        after = int(after)
+    return limit, after, None
+
+
+def parse_page_args():
+    """Read limit/after from the query string.
+
+    Returns (limit, after, error_response); error_response is set when
+    either value is malformed.
+    """
+    limit, after, error = page_args(request.args.get("limit"), request.args.get("after"))
+    if error:
+        return None, None, (jsonify({"error": error}), 400)
+    return limit, after, None
+
+
+def apply_keyset(stmt, column, limit=None, after=None):
+    """Order a select() by the key column and keep only rows after the cursor."""
+    if after is not None:
+        stmt = stmt.where(column > after)
+    stmt = stmt.order_by(column)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt.execution_options(yield_per=YIELD_PER)
+
+
+def streamed_response(chunks, **kwargs):
+    """Response that writes chunks as they are produced.
+
+    The request's database session is detached from the request and kept
+    open until the last chunk has been written, or the client goes away.
+    """
+    session = detach_session()
+
+    def close():
+        if session is not None:
+            session.close()
+
+    def generate():
+        try:
+            yield from chunks
+        finally:
+            close()
+
+    response = Response(stream_with_context(generate()), **kwargs)
+    # a generator that never starts never reaches its finally
+    response.call_on_close(close)
+    return response
+
+
+def stream_json_array(rows, serialize, empty_response=None):
+    """Stream an iterable of rows as a JSON array.
+
+    The first row is fetched up front so an empty result can still be turned
+    into empty_response (e.g. a 404) before any bytes are sent.
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        if empty_response is not None:
+            return empty_response
+        return Response("[]", mimetype="application/json")
+
+    def generate():
+        chunk = [dumps(serialize(first))]
+        prefix = b"["
+        for row in rows:
+            chunk.append(dumps(serialize(row)))
+            if len(chunk) >= FLUSH_ROWS:
+                yield prefix + b",".join(chunk)
+                chunk = []
+                prefix = b","
+        yield (prefix + b",".join(chunk) if chunk else b"") + b"]"
+
+    return streamed_response(generate(), mimetype="application/json")
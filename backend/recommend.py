@@ -0,0 +1,262 @@
+"""
+"Readers who borrowed this also borrowed" for GET /books/<id>/similar.
+
+Each reader's basket is the set of distinct books they have ever borrowed
+(issued_books, returned or not). Two books are related by how many readers
+borrowed both, scaled by how widely each one is read (cosine similarity
+over the reader x book matrix), so a bestseller that everybody borrows
+does not top every list. The top SIMILAR_TOP_N books per title are
+precomputed and held in memory; a request is a dict lookup plus one
+query for the books' details.
+
+The full build multiplies the sparse reader x book matrix by its
+transpose with SciPy when numpy and scipy are installed
+(requirements-recommend.txt), and falls back to counting pairs per basket
+in pure Python otherwise; both give the same lists. They are imported on
+the first build, not with the app.
+
+New loans update the index in place: the reader's basket grows and the
+lists of the books in it are recomputed on their next request, not in the
+checkout. (Other lists that include the new book keep its old reader count
+until the next rebuild, which only nudges their scores.) The index is
+rebuilt in the background once it is older than RECOMMEND_INDEX_MAX_AGE,
+which also picks up loans made through other worker processes and deleted
+books or users.
+"""
+from collections import Counter
+import heapq
+import math
+import os
+import threading
+import time
+import traceback
+
+from sqlalchemy import select
+
+from models import IssuedBook
+
+DEFAULT_LIMIT = 10
+SIMILAR_TOP_N = 50
+
+# a pair needs at least this many shared readers; 1 would show what a
+# single person read
+MIN_CO_BORROWERS = int(os.environ.get("RECOMMEND_MIN_CO_BORROWERS", 2))
+# baskets larger than this (staff and test accounts) are left out: they
+# relate everything to everything and cost their size squared
+MAX_BASKET = int(os.environ.get("RECOMMEND_MAX_BASKET", 500))
+
+INDEX_MAX_AGE = float(os.environ.get("RECOMMEND_INDEX_MAX_AGE", 900))
+
+
+class SimilarBooks:
+    """Reader baskets plus the precomputed top-N similar books per book."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._baskets = {}      # user_id -> set of book_ids
+        self._borrowers = {}    # book_id -> set of user_ids
+        self._readers = Counter()   # book_id -> readers whose basket counts
+        self._similar = {}      # book_id -> [(book_id, score, co_borrowers), ...]
+        self._dirty = set()     # books whose list is recomputed on next request
+        self._pending = None    # loans recorded while a build is running
+        self._built_at = None
+        self._vectorized = False
+
+    # -- building --------------------------------------------------------
+
+    def build(self, session):
+        started = time.perf_counter()
+        with self._lock:
+            self._pending = []
+        try:
+            baskets, borrowers = {}, {}
+            pairs = select(IssuedBook.user_id, IssuedBook.book_id).distinct()
+            for user_id, book_id in session.execute(pairs.execution_options(yield_per=10000)):
+                baskets.setdefault(user_id, set()).add(book_id)
+                borrowers.setdefault(book_id, set()).add(user_id)
+            readers = Counter(
+                book_id for basket in baskets.values() if len(basket) <= MAX_BASKET for book_id in basket
+            )
+            scipy = _import_scipy()
+            if scipy is not None:
+                similar = _top_n_vectorized(baskets, *scipy)
+            else:
+                similar = {
+                    book_id: _top_n(_co_borrowers(book_id, baskets, borrowers), readers, book_id)
+                    for book_id in borrowers
+                }
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            self._baskets = baskets
+            self._borrowers = borrowers
+            self._readers = readers
+            self._similar = similar
+            self._dirty = set()
+            pending, self._pending = self._pending, None
+            for user_id, book_id in pending:
+                self._record_locked(user_id, book_id)
+            self._built_at = time.monotonic()
+            self._vectorized = scipy is not None
+        print(f"Similar books: {len(borrowers)} books, {len(baskets)} readers "
+              f"({'scipy' if scipy is not None else 'python'}, "
+              f"{(time.perf_counter() - started) * 1000:.0f} ms)")
+
+    def ready(self):
+        return self._built_at is not None
+
+    def needs_rebuild(self):
+        return self._built_at is None or time.monotonic() - self._built_at >= INDEX_MAX_AGE
+
+    def refresh(self, session_factory, wait=False):
+        """Rebuild if needed: in this thread when wait is set, else in a background thread."""
+        if not self.needs_rebuild():
+            return
+        if wait:
+            with self._build_lock:
+                if self.needs_rebuild():
+                    self._build_with(session_factory)
+            return
+        if self._build_lock.locked():
+            return
+        threading.Thread(target=self._refresh_in_background, args=(session_factory,),
+                         name="similar-books", daemon=True).start()
+
+    def _refresh_in_background(self, session_factory):
+        if not self._build_lock.acquire(blocking=False):
+            return
+        try:
+            if self.needs_rebuild():
+                self._build_with(session_factory)
+        except Exception as e:
+            print(f"Similar books build failed: {str(e)}")
+            traceback.print_exc()
+        finally:
+            self._build_lock.release()
+
+    def _build_with(self, session_factory):
+        with session_factory() as session:
+            self.build(session)
+
+    # -- incremental updates ---------------------------------------------
+
+    def record_loan(self, user_id, book_id):
+        """Add one new loan to the reader's basket."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((user_id, book_id))
+            if self.ready():
+                self._record_locked(user_id, book_id)
+
+    def _record_locked(self, user_id, book_id):
+        basket = self._baskets.setdefault(user_id, set())
+        if book_id in basket:
+            return  # borrowed before: the pairs are already counted
+        basket.add(book_id)
+        self._borrowers.setdefault(book_id, set()).add(user_id)
+        if len(basket) <= MAX_BASKET:
+            self._readers[book_id] += 1
+            self._dirty.update(basket)
+        elif len(basket) == MAX_BASKET + 1:
+            # the reader just outgrew MAX_BASKET: take their basket out
+            for other in basket:
+                if other != book_id:
+                    self._readers[other] -= 1
+            self._dirty.update(basket)
+
+    # -- lookup ----------------------------------------------------------
+
+    def similar(self, book_id, limit=DEFAULT_LIMIT):
+        """[(book_id, score, co_borrowers), ...], most similar first."""
+        with self._lock:
+            if book_id in self._dirty:
+                self._dirty.discard(book_id)
+                row = _co_borrowers(book_id, self._baskets, self._borrowers)
+                self._similar[book_id] = _top_n(row, self._readers, book_id)
+            return self._similar.get(book_id, [])[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "books": len(self._borrowers),
+                "readers": len(self._baskets),
+                "dirty": len(self._dirty),
+                "age_seconds": None if self._built_at is None else time.monotonic() - self._built_at,
+                "vectorized": self._vectorized,
+            }
+
+
+def _import_scipy():
+    """(numpy, scipy.sparse), or None when they are not installed."""
+    try:
+        import numpy
+        from scipy import sparse
+    except ImportError:  # optional; the pure-Python build gives the same result
+        return None
+    return numpy, sparse
+
+
+def _co_borrowers(book_id, baskets, borrowers):
+    """Counter of book_id -> readers who borrowed it and book_id."""
+    counts = Counter()
+    for user_id in borrowers.get(book_id, ()):
+        basket = baskets[user_id]
+        if len(basket) <= MAX_BASKET:
+            counts.update(basket)
+    counts.pop(book_id, None)
+    return counts
+
+
+def _top_n(counts, readers, book_id):
+    own = readers.get(book_id, 0)
+    if not own:
+        return []
+    scored = (
+        (count / math.sqrt(own * readers[other]), count, -other)
+        for other, count in counts.items()
+        if count >= MIN_CO_BORROWERS
+    )
+    return [(-other, score, count) for score, count, other in heapq.nlargest(SIMILAR_TOP_N, scored)]
+
+
+def _top_n_vectorized(baskets, np, sparse):
+    """The same lists as _top_n for every book, from one sparse matrix product."""
+    users, books = [], []
+    for user_id, basket in baskets.items():
+        if len(basket) <= MAX_BASKET:
+            users.extend([user_id] * len(basket))
+            books.extend(basket)
+    if not books:
+        return {}
+    book_ids, cols = np.unique(np.array(books, dtype=np.int64), return_inverse=True)
+    _, rows = np.unique(np.array(users, dtype=np.int64), return_inverse=True)
+    borrowed = sparse.csr_matrix(
+        (np.ones(len(cols), dtype=np.float32), (rows, cols)), shape=(rows.max() + 1, len(book_ids))
+    )
+    readers = np.asarray(borrowed.sum(axis=0), dtype=np.float64).ravel()
+
+    # book x book co-borrow counts; the diagonal is each book's own readers
+    co = (borrowed.T @ borrowed).tocoo()
+    keep = (co.row != co.col) & (co.data >= MIN_CO_BORROWERS)
+    row, col, count = co.row[keep], co.col[keep], co.data[keep].astype(np.int64)
+    score = count / np.sqrt(readers[row] * readers[col])
+
+    # best first within each book (ties: more shared readers, then lower id),
+    # then keep the first SIMILAR_TOP_N of each book's run
+    order = np.lexsort((book_ids[col], -count, -score, row))
+    row, col, count, score = row[order], col[order], count[order], score[order]
+    rank = np.arange(len(row)) - np.searchsorted(row, row)
+    top = rank < SIMILAR_TOP_N
+
+    similar = {}
+    for book, other, n, s in zip(book_ids[row[top]].tolist(), book_ids[col[top]].tolist(),
+                                 count[top].tolist(), score[top].tolist()):
+        similar.setdefault(book, []).append((other, s, n))
+    return similar
+
+
+similar_books = SimilarBooks()
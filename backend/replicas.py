@@ -0,0 +1,210 @@
+"""
+Read replicas for the read-only views.
+
+DATABASE_REPLICA_URLS is a comma-separated list of database URLs (for
+example PostgreSQL streaming replicas). Views marked with
+database.read_only send their plain SELECTs to one of them, picked
+round-robin per request; writes, SELECT ... FOR UPDATE and anything after
+a write in the same request still go to the primary.
+
+Health: a replica is pinged when it is first used and again every
+REPLICA_CHECK_INTERVAL seconds; on PostgreSQL the check also reads its
+replay lag and takes it out of rotation while that exceeds
+REPLICA_MAX_LAG_SECONDS. A replica that fails a check or drops a
+connection is skipped for REPLICA_RETRY_SECONDS. With no healthy replica
+reads fall back to the primary.
+
+Read-your-writes: a client whose request wrote to the primary reads from
+the primary for the next REPLICA_STICKY_SECONDS, so the loan list right
+after a checkout or return already shows it. The window travels with the
+client, so whichever worker serves the next read honours it: write
+responses carry a signed "primary until" timestamp in the X-Primary-Until
+header and a primary_until cookie, and a request presenting either (the
+dashboard echoes the header) reads from the primary until then. The
+worker that took the write also remembers the user for clients that send
+neither.
+
+Without DATABASE_REPLICA_URLS everything runs on the primary as before.
+"""
+import hashlib
+import hmac
+import itertools
+import os
+import threading
+import time
+
+from sqlalchemy import event, text
+
+from auth.cache import TTLCache
+
+REPLICA_URLS = [
+    url.strip().replace("postgres://", "postgresql://", 1)
+    for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+STICKY_SECONDS = float(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+CHECK_INTERVAL = float(os.environ.get("REPLICA_CHECK_INTERVAL", 10))
+RETRY_SECONDS = float(os.environ.get("REPLICA_RETRY_SECONDS", 30))
+MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 30))
+
+PRIMARY_UNTIL_HEADER = "X-Primary-Until"
+PRIMARY_UNTIL_COOKIE = "primary_until"
+
+# 0 when the replica has replayed everything it received, so an idle
+# primary does not look like lag
+_PG_LAG = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+def _signature(value, secret):
+    return hmac.new(secret.encode("utf-8"), value.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+
+def sign_primary_until(until, secret):
+    """Token telling any worker to read from the primary until this unix time."""
+    value = str(int(until * 1000))
+    return f"{value}.{_signature(value, secret)}"
+
+
+def primary_until(token, secret):
+    """Unix time a valid token pins its client to the primary until; 0 if invalid."""
+    value, _, signature = (token or "").partition(".")
+    if not value.isdigit() or not hmac.compare_digest(signature, _signature(value, secret)):
+        return 0
+    return int(value) / 1000
+
+
+def _display_name(url):
+    return url.split("@")[1] if "@" in url else url.rsplit("/", 1)[-1]
+
+
+class Replica:
+    def __init__(self, url, engine_factory):
+        self.url = url
+        self.name = _display_name(url)
+        self._engine_factory = engine_factory
+        self._engine = None
+        self._engine_lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self.healthy = True
+        self.checked_at = None
+        self.lag = None
+        self.reads = 0
+        self.failures = 0
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    engine = self._engine_factory(self.url)
+                    event.listen(engine, "handle_error", self._on_error)
+                    self._engine = engine
+        return self._engine
+
+    def _on_error(self, exception_context):
+        # a lost or refused connection takes the replica out of rotation;
+        # ordinary statement errors do not (nor does a failing health
+        # check, which marks it down itself)
+        if self._check_lock.locked():
+            return
+        if exception_context.is_disconnect or exception_context.connection is None:
+            self.mark_down(exception_context.original_exception)
+
+    def mark_down(self, error):
+        if self.healthy:
+            print(f"Replica {self.name} is down: {str(error)}")
+        self.healthy = False
+        self.failures += 1
+        self.checked_at = time.monotonic()
+
+    def due_for_check(self, now):
+        if self.checked_at is None:
+            return True
+        return now - self.checked_at >= (CHECK_INTERVAL if self.healthy else RETRY_SECONDS)
+
+    def check(self):
+        """Ping the replica (and read its replay lag on PostgreSQL)."""
+        if not self._check_lock.acquire(blocking=False):
+            return self.healthy  # another thread is checking it right now
+        try:
+            with self.engine.connect() as connection:
+                if connection.dialect.name == "postgresql":
+                    lag = connection.execute(_PG_LAG).scalar()
+                else:
+                    connection.execute(text("SELECT 1"))
+                    lag = None
+            self.lag = float(lag) if lag is not None else None
+            was_healthy = self.healthy
+            self.healthy = self.lag is None or self.lag <= MAX_LAG_SECONDS
+            if self.healthy and not was_healthy:
+                print(f"Replica {self.name} is back in rotation")
+            elif not self.healthy:
+                print(f"Replica {self.name} is {self.lag:.1f}s behind; skipping it")
+        except Exception as e:
+            self.mark_down(e)
+        finally:
+            self.checked_at = time.monotonic()
+            self._check_lock.release()
+        return self.healthy
+
+    def dispose_after_fork(self):
+        if self._engine is not None:
+            self._engine.dispose(close=False)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "lag_seconds": self.lag,
+            "reads": self.reads,
+            "failures": self.failures,
+        }
+
+
+class ReplicaSet:
+    def __init__(self, urls, engine_factory):
+        self.replicas = [Replica(url, engine_factory) for url in urls]
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._recent_writers = TTLCache(maxsize=10000, ttl=STICKY_SECONDS)
+        self.fallbacks = 0
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def pick(self):
+        """Next healthy replica, round-robin; None (use the primary) when there is none."""
+        now = time.monotonic()
+        start = next(self._counter)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if replica.due_for_check(now):
+                replica.check()
+            if replica.healthy:
+                with self._lock:
+                    replica.reads += 1
+                return replica
+        with self._lock:
+            self.fallbacks += 1
+        return None
+
+    def note_write(self, user_id):
+        if user_id is not None and STICKY_SECONDS > 0:
+            self._recent_writers.set(user_id, True)
+
+    def is_sticky(self, user_id):
+        return user_id is not None and self._recent_writers.get(user_id) is not None
+
+    def after_fork(self):
+        for replica in self.replicas:
+            replica.dispose_after_fork()
+
+    def stats(self):
+        return {
+            "replicas": [replica.stats() for replica in self.replicas],
+            "fallbacks": self.fallbacks,
+            "sticky_users": self._recent_writers.stats()["size"],
+        }
@@ -0,0 +1,175 @@
+"""
+Response cache and conditional GET for read-heavy endpoints.
+
+@cached_response("books", "authors") on a GET view:
+  * derives an ETag from the route, the query string and the versions of
+    the listed tables (see table_versions), plus Last-Modified from the
+    time those tables last changed;
+  * answers If-None-Match / If-Modified-Since with 304 before the view
+    runs, so a revalidation never touches the database;
+  * keeps recent bodies in a store keyed the same way and replays them
+    until a write bumps one of the tables.
+
+Table versions are counted per process, so a write handled by another
+worker does not change them here. Keys and validators therefore also
+carry the current RESPONSE_CACHE_TTL window of the wall clock (the same
+in every worker): nothing cached or revalidated outlives the TTL, which
+bounds how stale another worker's answer can be. Last-Modified is never
+earlier than the start of that window, and is left out while the tables
+changed within the current second (it only has one-second resolution).
+
+A body read from a replica within REPLICA_STICKY_SECONDS of a write to its
+tables may predate that write, so it is neither stored nor given
+validators (the replica may simply not have replayed it yet).
+
+The store only needs get(key) and set(key, value, ttl); the default is an
+in-process TTL/LRU cache and set_store() plugs in another one.
+"""
+from datetime import datetime, timezone
+from functools import wraps
+import hashlib
+import os
+import secrets
+import time
+
+from flask import Response, make_response, request
+
+from auth.cache import TTLCache
+from database import served_by_replica
+from replicas import STICKY_SECONDS
+from table_versions import table_versions
+
+CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 60))
+CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+# larger bodies are still streamed and get an ETag, they are just not stored
+MAX_BODY_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 1024 * 1024))
+
+# versions are per process, so ETags from different workers must not collide
+_PROCESS_TAG = secrets.token_hex(4)
+
+CACHEABLE_STATUS = (200, 404)
+
+
+class LocalStore:
+    """Default store: a bounded in-process TTL/LRU mapping."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._cache.set(key, value, ttl=ttl)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+_store = LocalStore()
+
+
+def set_store(store):
+    global _store
+    _store = store
+
+
+def get_store():
+    return _store
+
+
+def _http_date(timestamp):
+    return datetime.fromtimestamp(int(timestamp), tz=timezone.utc)
+
+
+def validators(path, query_string, tables, now=None):
+    """(cache key, ETag, Last-Modified or None) for a GET of path?query_string."""
+    now = time.time() if now is None else now
+    query = "&".join(sorted(query_string.split("&")))
+    versions = table_versions.key(tables)
+    epoch = int(now // CACHE_TTL)
+    key = (path, query, versions, epoch)
+    etag = hashlib.sha1(
+        f"{_PROCESS_TAG}|{path}?{query}|{versions}|{epoch}".encode("utf-8")
+    ).hexdigest()[:32]
+    changed = table_versions.last_modified(tables)
+    if int(changed) >= int(now):
+        # another write this second would not move a whole-second date
+        return key, etag, None
+    return key, etag, _http_date(max(changed, epoch * CACHE_TTL))
+
+
+def not_modified(if_none_match, if_modified_since, etag, last_modified):
+    """Evaluate parsed If-None-Match / If-Modified-Since request headers."""
+    if if_none_match:
+        return if_none_match.contains(etag)
+    if if_modified_since and last_modified is not None:
+        return if_modified_since >= last_modified
+    return False
+
+
+def _set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def _may_predate_write(tables):
+    """A replica answered while a write to tables may not have reached it."""
+    return served_by_replica() and time.time() - table_versions.last_modified(tables) < STICKY_SECONDS
+
+
+def _capture(chunks, key, status, mimetype):
+    """Pass a streamed body through, storing it if it stays small enough."""
+    body = []
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if body is not None:
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                body = None
+            else:
+                body.append(chunk)
+        yield chunk
+    if body is not None:
+        _store.set(key, (b"".join(body), status, mimetype))
+
+
+def cached_response(*tables):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or CACHE_TTL <= 0:
+                return view(*args, **kwargs)
+
+            key, etag, last_modified = validators(
+                request.path, request.query_string.decode("latin-1"), tables
+            )
+            if not_modified(request.if_none_match, request.if_modified_since, etag, last_modified):
+                return _set_validators(Response(status=304), etag, last_modified)
+
+            cached = _store.get(key)
+            if cached is not None:
+                body, status, mimetype = cached
+                return _set_validators(Response(body, status=status, mimetype=mimetype), etag, last_modified)
+
+            rv = view(*args, **kwargs)
+            response = make_response(rv)
+            if response.status_code not in CACHEABLE_STATUS or _may_predate_write(tables):
+                return response
+
+            if response.is_streamed:
+                response.response = _capture(response.response, key, response.status_code, response.mimetype)
+            else:
+                body = response.get_data()
+                if len(body) <= MAX_BODY_BYTES:
+                    _store.set(key, (body, response.status_code, response.mimetype))
+            return _set_validators(response, etag, last_modified)
+
+        return wrapper
+
+    return decorator
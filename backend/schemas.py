@@ -0,0 +1,123 @@
+"""
+Column-level serializers for the list endpoints.
+
+A Schema names the keys of one JSON object and the column behind each
+key. Views select exactly those columns (Schema.select() adds the outer
+joins the columns need) and get plain row tuples back, so listing
+thousands of rows never builds ORM instances, fills the identity map or
+loads relationships. dump() zips the precomputed key tuple onto a row.
+
+dumps() encodes with orjson when it is installed and falls back to the
+standard json module; both write datetimes as ISO 8601.
+"""
+from datetime import date, datetime
+import json
+
+from flask import Response
+from sqlalchemy import select
+
+from models import Book, Author, Copy, User, IssuedBook
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+_encoder = json.JSONEncoder(separators=(",", ":"), default=_default)
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return _encoder.encode(data).encode("utf-8")
+
+
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype="application/json")
+
+
+class Schema:
+    def __init__(self, base, fields, joins=()):
+        self.base = base
+        self.fields = tuple(fields)
+        self.keys = tuple(key for key, _ in self.fields)
+        self.columns = tuple(column for _, column in self.fields)
+        self.joins = tuple(joins)
+
+    def extend(self, *fields):
+        return Schema(self.base, self.fields + fields, self.joins)
+
+    def select(self, *leading):
+        """SELECT of the schema's columns; leading columns come first in each row."""
+        stmt = select(*leading, *self.columns).select_from(self.base)
+        for target, onclause in self.joins:
+            stmt = stmt.outerjoin(target, onclause)
+        return stmt
+
+    def dump(self, row):
+        return dict(zip(self.keys, row))
+
+    def dump_all(self, rows):
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in rows]
+
+
+BOOK_SEARCH = Schema(Book, (
+    ("id", Book.id),
+    ("title", Book.title),
+    ("category", Book.category),
+    ("status", Book.status),
+    ("available_copies", Book.available_copies),
+    ("total_copies", Book.total_copies),
+    ("author_id", Book.author_id),
+    ("author_name", Author.name),
+), joins=((Author, Book.author_id == Author.id),))
+
+BOOK = BOOK_SEARCH.extend(("isbn", Book.isbn))
+
+COPY = Schema(Copy, (
+    ("id", Copy.id),
+    ("book_id", Copy.book_id),
+    ("status", Copy.status),
+))
+
+AUTHOR = Schema(Author, (
+    ("id", Author.id),
+    ("name", Author.name),
+    ("bio", Author.bio),
+))
+
+USER = Schema(User, (
+    ("id", User.id),
+    ("name", User.name),
+    ("email", User.email),
+    ("role", User.role),
+))
+
+ISSUED_BOOK = Schema(IssuedBook, (
+    ("id", IssuedBook.id),
+    ("book_id", IssuedBook.book_id),
+    ("copy_id", IssuedBook.copy_id),
+    ("book_title", Book.title),
+    ("user_id", IssuedBook.user_id),
+    ("user_name", User.name),
+    ("status", IssuedBook.status),
+    ("issued_at", IssuedBook.issued_at),
+    ("due_at", IssuedBook.due_at),
+    ("returned_at", IssuedBook.returned_at),
+), joins=((Book, IssuedBook.book_id == Book.id), (User, IssuedBook.user_id == User.id)))
+
+# loans nested under a user in GET /users
+USER_LOAN = Schema(IssuedBook, (
+    ("id", IssuedBook.id),
+    ("book_id", IssuedBook.book_id),
+    ("book_title", Book.title),
+    ("status", IssuedBook.status),
+), joins=((Book, IssuedBook.book_id == Book.id),))
@@ -0,0 +1,310 @@
+"""
+Relevance-ranked book search.
+
+On PostgreSQL the title/category/author filters are served by pg_trgm GIN
+indexes (created by migrate.py) and results are ordered by similarity().
+Other databases (SQLite test deployments) use an in-process inverted
+trigram index that is rebuilt lazily after catalog writes.
+
+Ranked results are paged with ?limit=&offset=<rows already seen>. Keyset
+paging (?after=<last id>) walks id order, so a text search only accepts it
+together with ?order=id; anything else is a 400 rather than a silent switch
+to a different order.
+"""
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import func, select, text
+
+from models import Book, Author
+import schemas
+
+# field weights used by both backends when combining per-field scores
+WEIGHTS = {"title": 1.0, "author": 0.6, "category": 0.4}
+
+# rows loaded per IN (...) query when materialising in-process results
+FETCH_CHUNK = 500
+
+# rebuild the in-process index at least this often, so writes made by other
+# worker processes are eventually picked up
+INDEX_MAX_AGE = float(os.environ.get("SEARCH_INDEX_MAX_AGE", 300))
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def parse_search_path(search_param, category, status, author):
+    """Interpret the /books/search/<search_param>/<category>/<status>/<author> segments.
+
+    Returns (book_id, title, category, status, author). A numeric
+    search_param is a book id; "all" is the frontend's placeholder for an
+    unused segment.
+    """
+    book_id = None
+    title = None
+    if search_param:
+        sp = search_param.strip()
+        if sp.lower() == "all":
+            pass
+        elif sp.isdigit():
+            book_id = int(sp)
+        else:
+            title = sp
+
+    category, status, author = (
+        None if value and value.strip().lower() == "all" else value
+        for value in (category, status, author)
+    )
+    return book_id, title, category, status, author
+
+
+def is_ranked(book_id, title, category, author, order=None):
+    """Text searches are ranked unless the client asks for ?order=id."""
+    return bool(title or category or author) and book_id is None and order != "id"
+
+
+def page_order(book_id, title, category, author, order, offset, after):
+    """Check the ordering and paging arguments of a search.
+
+    Returns (ranked, offset, error); error is a message when the arguments
+    are malformed or page in a different order than the results use.
+    """
+    if order not in (None, "id"):
+        return None, None, "order must be id"
+    if offset is not None and not offset.isdigit():
+        return None, None, "offset must be a non-negative integer"
+    offset = int(offset or 0)
+    ranked = is_ranked(book_id, title, category, author, order)
+    if ranked and after is not None:
+        return None, None, "after pages in id order: add order=id, or page ranked results with offset"
+    if not ranked and offset:
+        return None, None, "offset pages ranked results; page id order with after"
+    return ranked, offset, None
+
+
+def filter_criteria(title=None, category=None, status=None, author=None, author_joined=False):
+    """Substring filters shared by the search endpoints, as WHERE clauses.
+
+    With author_joined the statement already joins authors (the schemas.BOOK
+    selects do); otherwise the author filter is a subquery, which also works
+    in UPDATE/DELETE.
+    """
+    criteria = []
+    if title:
+        criteria.append(Book.title.ilike(f"%{title}%"))
+    if category:
+        criteria.append(Book.category.ilike(f"%{category}%"))
+    if status:
+        criteria.append(Book.status.ilike(f"%{status}%"))
+    if author:
+        if author_joined:
+            criteria.append(Author.name.ilike(f"%{author}%"))
+        else:
+            criteria.append(Book.author_id.in_(
+                select(Author.id).where(Author.name.ilike(f"%{author}%"))
+            ))
+    return criteria
+
+
+def apply_filters(stmt, title=None, category=None, status=None, author=None):
+    """Apply the search filters to a schemas.BOOK / BOOK_SEARCH select."""
+    return stmt.where(*filter_criteria(title, category, status, author, author_joined=True))
+
+
+def ranked_books(session, title=None, category=None, status=None, author=None, limit=None, offset=0):
+    """Return matching schemas.BOOK_SEARCH rows, most relevant first, skipping offset of them."""
+    if session.get_bind().dialect.name == "postgresql":
+        stmt = apply_filters(schemas.BOOK_SEARCH.select(), title, category, status, author)
+        if has_pg_trgm(session):
+            stmt = stmt.order_by(*pg_rank_order(title, category, author))
+        else:
+            stmt = stmt.order_by(Book.id)
+        if offset:
+            stmt = stmt.offset(offset)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return session.execute(stmt.execution_options(yield_per=FETCH_CHUNK))
+    return _indexed_ranked(session, title, category, status, author, limit, offset)
+
+
+# -- PostgreSQL --------------------------------------------------------------
+
+_pg_trgm_available = None
+
+
+def has_pg_trgm(session):
+    global _pg_trgm_available
+    if _pg_trgm_available is None:
+        found = session.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        ).first()
+        _pg_trgm_available = found is not None
+        if not _pg_trgm_available:
+            print("⚠ pg_trgm is not installed; run migrate.py to enable ranked search")
+    return _pg_trgm_available
+
+
+def pg_rank_order(title=None, category=None, author=None):
+    """ORDER BY clauses ranking rows by weighted trigram similarity.
+
+    The author term refers to Author.name, so the statement must join
+    authors (the schemas.BOOK selects do).
+    """
+    rank = []
+    if title:
+        rank.append(func.similarity(Book.title, title) * WEIGHTS["title"])
+    if category:
+        rank.append(func.similarity(Book.category, category) * WEIGHTS["category"])
+    if author:
+        rank.append(func.similarity(Author.name, author) * WEIGHTS["author"])
+    if not rank:
+        return [Book.id]
+    score = rank[0]
+    for term in rank[1:]:
+        score = score + term
+    return [score.desc(), Book.id]
+
+
+# -- in-process fallback -----------------------------------------------------
+
+def _trigrams(value):
+    value = f"  {value} "
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class BookIndex:
+    """Inverted trigram index over book title, category and author name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._postings = {field: {} for field in WEIGHTS}
+        self._built_at = None
+        self._generation = 0
+        self._built_generation = None
+
+    def invalidate(self):
+        """Mark the index stale; it is rebuilt on the next search."""
+        self._generation += 1
+
+    def _ensure_built(self, session):
+        generation = self._generation
+        if (
+            self._built_generation == generation
+            and time.monotonic() - self._built_at < INDEX_MAX_AGE
+        ):
+            return
+        docs = {}
+        postings = {field: {} for field in WEIGHTS}
+        rows = (
+            session.query(Book.id, Book.title, Book.category, Author.name)
+            .outerjoin(Author, Book.author_id == Author.id)
+            .yield_per(FETCH_CHUNK)
+        )
+        for book_id, title, category, author_name in rows:
+            doc = {
+                "title": (title or "").lower(),
+                "category": (category or "").lower(),
+                "author": (author_name or "").lower(),
+            }
+            docs[book_id] = doc
+            for field, value in doc.items():
+                for gram in _trigrams(value):
+                    postings[field].setdefault(gram, set()).add(book_id)
+        with self._lock:
+            self._docs = docs
+            self._postings = postings
+            self._built_at = time.monotonic()
+            self._built_generation = generation
+
+    def _candidates(self, field, term):
+        grams = _trigrams(term)
+        # the padded edge trigrams only match at word boundaries, so keep
+        # the interior ones for substring matching
+        inner = {g for g in grams if " " not in g} or None
+        if inner is None:
+            return None
+        postings = self._postings[field]
+        result = None
+        for gram in sorted(inner, key=lambda g: len(postings.get(g, ()))):
+            ids = postings.get(gram)
+            if not ids:
+                return set()
+            result = set(ids) if result is None else result & ids
+            if not result:
+                break
+        return result
+
+    @staticmethod
+    def _score(value, term):
+        if value == term:
+            return 3.0
+        if value.startswith(term):
+            return 2.0 + len(term) / len(value)
+        if any(word.startswith(term) for word in _WORD_RE.findall(value)):
+            return 1.5 + len(term) / len(value)
+        return 1.0 + len(term) / len(value)
+
+    def search(self, session, terms):
+        """Return book ids matching every term, best match first.
+
+        terms maps a field name (title/category/author) to a search string.
+        """
+        self._ensure_built(session)
+        terms = {field: term.lower() for field, term in terms.items() if term}
+        docs = self._docs
+
+        candidates = None
+        for field, term in terms.items():
+            ids = self._candidates(field, term)
+            if ids is None:
+                continue
+            candidates = ids if candidates is None else candidates & ids
+        if candidates is None:
+            candidates = docs.keys()
+
+        scored = []
+        for book_id in candidates:
+            doc = docs.get(book_id)
+            if doc is None:
+                continue
+            score = 0.0
+            for field, term in terms.items():
+                value = doc[field]
+                if term not in value:
+                    break
+                score += self._score(value, term) * WEIGHTS[field]
+            else:
+                scored.append((-score, book_id))
+        scored.sort()
+        return [book_id for _, book_id in scored]
+
+
+book_index = BookIndex()
+
+
+def _indexed_ranked(session, title, category, status, author, limit, offset=0):
+    ids = book_index.search(session, {"title": title, "category": category, "author": author})
+    if not status:
+        # every id is a row; with a status filter the rows are counted below
+        ids = ids[offset:offset + limit] if limit is not None else ids[offset:]
+        offset = 0
+
+    skipped = 0
+    sent = 0
+    for start in range(0, len(ids), FETCH_CHUNK):
+        chunk = ids[start:start + FETCH_CHUNK]
+        stmt = apply_filters(schemas.BOOK_SEARCH.select().where(Book.id.in_(chunk)), status=status)
+        found = {row.id: row for row in session.execute(stmt)}
+        for book_id in chunk:
+            book = found.get(book_id)
+            if book is None:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            yield book
+            sent += 1
+            if limit is not None and sent >= limit:
+                return
@@ -0,0 +1,104 @@
+"""
+Aggregated dashboard statistics for GET /stats.
+
+Everything is counted in SQL with GROUP BY so only the aggregates leave
+the database. Results are cached for a few seconds and keyed on the
+versions of the tables they read, so a checkout or catalog change shows up
+on the next request.
+"""
+import os
+
+from sqlalchemy import func, select
+
+from auth.cache import TTLCache
+from models import Book, Author, User, IssuedBook
+from table_versions import table_versions
+
+STATS_TABLES = ("books", "authors", "users", "issued_books")
+DEFAULT_TOP = 10
+MAX_TOP = 100
+
+_cache = TTLCache(maxsize=32, ttl=float(os.environ.get("STATS_CACHE_TTL", 30)))
+
+
+def get_stats(session, top=DEFAULT_TOP):
+    key = (top,) + table_versions.key(STATS_TABLES)
+    stats = _cache.get(key)
+    if stats is None:
+        stats = compute_stats(session, top)
+        _cache.set(key, stats)
+    return stats
+
+
+def compute_stats(session, top=DEFAULT_TOP):
+    by_status = dict(session.execute(
+        select(Book.status, func.count()).group_by(Book.status)
+    ).all())
+
+    loans = func.count(IssuedBook.id)
+
+    by_category = session.execute(
+        select(Book.category, func.count().label("n"))
+        .group_by(Book.category)
+        .order_by(func.count().desc(), Book.category)
+        .limit(top)
+    ).all()
+
+    by_author = session.execute(
+        select(Author.id, Author.name, func.count(Book.id).label("n"))
+        .join(Book, Book.author_id == Author.id)
+        .group_by(Author.id, Author.name)
+        .order_by(func.count(Book.id).desc(), Author.id)
+        .limit(top)
+    ).all()
+
+    active_loans = session.execute(
+        select(User.id, User.name, loans)
+        .join(IssuedBook, IssuedBook.user_id == User.id)
+        .where(IssuedBook.status == "issued")
+        .group_by(User.id, User.name)
+        .order_by(loans.desc(), User.id)
+        .limit(top)
+    ).all()
+
+    top_borrowed = session.execute(
+        select(Book.id, Book.title, loans)
+        .join(IssuedBook, IssuedBook.book_id == Book.id)
+        .group_by(Book.id, Book.title)
+        .order_by(loans.desc(), Book.id)
+        .limit(top)
+    ).all()
+
+    totals = session.execute(
+        select(
+            select(func.count()).select_from(Book).scalar_subquery(),
+            select(func.coalesce(func.sum(Book.total_copies), 0)).scalar_subquery(),
+            select(func.coalesce(func.sum(Book.available_copies), 0)).scalar_subquery(),
+            select(func.count()).select_from(Author).scalar_subquery(),
+            select(func.count()).select_from(User).scalar_subquery(),
+            select(func.count()).select_from(IssuedBook)
+            .where(IssuedBook.status == "issued").scalar_subquery(),
+        )
+    ).one()
+
+    return {
+        "totals": {
+            "books": totals[0],
+            "copies": totals[1],
+            "available_copies": totals[2],
+            "authors": totals[3],
+            "users": totals[4],
+            "active_loans": totals[5],
+        },
+        "books_by_status": by_status,
+        "books_by_category": [{"category": c, "count": n} for c, n in by_category],
+        "books_by_author": [
+            {"author_id": i, "author_name": name, "count": n} for i, name, n in by_author
+        ],
+        "active_loans_by_user": [
+            {"user_id": i, "user_name": name, "count": n} for i, name, n in active_loans
+        ],
+        "top_borrowed": [
+            {"book_id": i, "title": title, "count": n} for i, title, n in top_borrowed
+        ],
+    }
@@ -0,0 +1,360 @@
+"""
+Typeahead suggestions for GET /suggest?q=.
+
+An in-process prefix index over book titles and author names: every
+entry is filed under its normalized text (case-folded, accents and
+punctuation stripped) and under the text starting at each of its next few
+words, so "pot" finds "Harry Potter". The keys live in one sorted list
+searched with bisect and a lookup never touches the database.
+
+Every entry under a prefix is ranked, not just the first few keys in
+sorted order. A prefix that matches more than MAX_SCAN_KEYS keys ("a",
+"the", "hist") has its top MAX_LIMIT computed during the build, merged
+from the lists of its longer prefixes like the nodes of a trie, and the
+write endpoints keep those lists up to date in place. Any other prefix
+has at most MAX_SCAN_KEYS keys to rank; that is done outside the index
+lock and the result is cached per prefix. A write only drops the cached
+results of the prefixes of the keys it changed.
+
+The index is built in a background thread when the process serves its
+first request and kept current by the write endpoints (add/remove single
+entries in place). Bulk changes mark it stale instead; a stale or old
+index (SUGGEST_INDEX_MAX_AGE, which also picks up writes made by other
+worker processes) is rebuilt in the background while the current one
+keeps answering.
+"""
+from bisect import bisect_left, insort
+import heapq
+import os
+import re
+import threading
+import time
+import traceback
+import unicodedata
+
+from sqlalchemy import select
+
+from auth.cache import TTLCache
+from models import Book, Author
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+# keys per entry beyond its full text: one for each of the next words
+MAX_WORD_KEYS = 3
+# keys are cut to this many characters; longer queries are checked
+# against the entry's full text
+KEY_CHARS = 32
+# prefixes matching more keys than this have their top MAX_LIMIT
+# precomputed; fewer are ranked on lookup (well under a millisecond)
+MAX_SCAN_KEYS = 64
+# ranked results kept for the other prefixes; typeahead traffic repeats
+# the same prefixes, so most lookups are a cache hit
+RESULT_CACHE_SIZE = 4096
+
+INDEX_MAX_AGE = float(os.environ.get("SUGGEST_INDEX_MAX_AGE", 300))
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(_WORD_RE.findall(text.casefold()))
+
+
+def _keys(normalized):
+    """(key, word position) pairs an entry is filed under."""
+    keys = [(normalized[:KEY_CHARS], 0)]
+    position = 0
+    for match in re.finditer(r" ", normalized):
+        position += 1
+        if position > MAX_WORD_KEYS:
+            break
+        keys.append((normalized[match.end():match.end() + KEY_CHARS], position))
+    return keys
+
+
+def _key_range(keys, key_prefix, lo=0, hi=None):
+    """(start, end) of the keys that start with key_prefix."""
+    hi = len(keys) if hi is None else hi
+    if not key_prefix:
+        return lo, hi
+    start = bisect_left(keys, (key_prefix,), lo, hi)
+    end = bisect_left(keys, (key_prefix[:-1] + chr(ord(key_prefix[-1]) + 1),), start, hi)
+    return start, end
+
+
+def _row(entries, kind, entry_id, position):
+    """Sort key of a match: start-of-text matches first, then shorter texts.
+
+    None when the entry is gone (lookups rank outside the lock).
+    """
+    entry = entries.get((kind, entry_id))
+    if entry is None:
+        return None
+    text, normalized = entry
+    return (position > 0, len(normalized), normalized, kind, entry_id, text)
+
+
+def _best(rows):
+    """The first MAX_LIMIT of sorted rows, one per (kind, text)."""
+    best = []
+    seen = set()
+    for row in rows:
+        if (row[3], row[2]) in seen:
+            continue
+        seen.add((row[3], row[2]))
+        best.append(row)
+        if len(best) >= MAX_LIMIT:
+            break
+    return best
+
+
+def _rank(keys, entries, prefix):
+    """Top MAX_LIMIT rows among the (key, kind, id, position) keys that match prefix."""
+    # an entry filed under several matching keys gets a row for each; the
+    # best one sorts first and _best drops the rest as duplicates
+    ranked = [_row(entries, kind, entry_id, position) for _, kind, entry_id, position in keys]
+    ranked = [row for row in ranked if row is not None]
+    if len(prefix) > KEY_CHARS:
+        ranked = [row for row in ranked if f" {prefix}" in f" {row[2]}"]
+
+    # a few spare rows so dropped duplicates do not leave the list short
+    rows = heapq.nsmallest(MAX_LIMIT * 2, ranked)
+    best = _best(rows)
+    if len(best) < MAX_LIMIT and len(rows) < len(ranked):
+        best = _best(sorted(ranked))
+    return best
+
+
+def _children(keys, key_prefix, start, end):
+    """(prefix, start, end) runs of keys[start:end], one character longer than key_prefix.
+
+    Keys equal to key_prefix form a run of their own, under key_prefix.
+    """
+    i = start
+    while i < end:
+        key = keys[i][0]
+        if len(key) == len(key_prefix):
+            child, j = key, bisect_left(keys, (key + "\0",), i, end)
+        else:
+            child = key[:len(key_prefix) + 1]
+            j = _key_range(keys, child, i, end)[1]
+        yield child, i, j
+        i = j
+
+
+def _merge_children(keys, entries, key_prefix, start, end, top):
+    """Top rows for key_prefix from its runs: stored lists where there are, else ranked.
+
+    A run's list only drops rows ranked below its own top MAX_LIMIT, so the
+    merge cannot miss a row.
+    """
+    rows = []
+    for child, i, j in _children(keys, key_prefix, start, end):
+        if child != key_prefix and child in top:
+            rows.extend(top[child])
+        else:
+            rows.extend(_rank(keys[i:j], entries, child))
+    return _best(sorted(rows))
+
+
+def _top_prefixes(keys, entries, key_prefix="", start=0, end=None, top=None):
+    """{prefix: top rows} for every prefix matching more than MAX_SCAN_KEYS keys.
+
+    Walks the sorted keys like a trie, deepest prefixes first, so each key
+    is ranked once and every longer list is merged into its parent's.
+    """
+    end = len(keys) if end is None else end
+    top = {} if top is None else top
+    if end - start > MAX_SCAN_KEYS and len(key_prefix) < KEY_CHARS:
+        for child, i, j in _children(keys, key_prefix, start, end):
+            if child != key_prefix:
+                _top_prefixes(keys, entries, child, i, j, top)
+    if end - start > MAX_SCAN_KEYS and key_prefix:
+        top[key_prefix] = _merge_children(keys, entries, key_prefix, start, end, top)
+    return top
+
+
+class SuggestIndex:
+    """Sorted (key, kind, id) tuples plus the entries they point to."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._keys = []
+        self._entries = {}
+        self._top = {}
+        self._version = 0       # bumped by every change, so a stale ranking is not cached
+        self._built_at = None
+        self._stale = False
+        self._results = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=INDEX_MAX_AGE)
+
+    # -- building --------------------------------------------------------
+
+    def build(self, session):
+        started = time.perf_counter()
+        entries = {}
+        for book_id, title in session.execute(select(Book.id, Book.title).execution_options(yield_per=5000)):
+            entries[("book", book_id)] = (title, normalize(title))
+        for author_id, name in session.execute(select(Author.id, Author.name)):
+            entries[("author", author_id)] = (name, normalize(name))
+        keys = sorted(
+            (key, ref[0], ref[1], position)
+            for ref, (_, normalized) in entries.items()
+            for key, position in _keys(normalized)
+        )
+        top = _top_prefixes(keys, entries)
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._top = top
+            self._version += 1
+            self._built_at = time.monotonic()
+            self._stale = False
+            self._results.clear()
+        print(f"Suggest index: {len(entries)} entries, {len(keys)} keys "
+              f"({(time.perf_counter() - started) * 1000:.0f} ms)")
+
+    def ready(self):
+        return self._built_at is not None
+
+    def needs_rebuild(self):
+        return self._built_at is None or self._stale or time.monotonic() - self._built_at >= INDEX_MAX_AGE
+
+    def invalidate(self):
+        """Mark the index stale after a bulk change; it is rebuilt in the background."""
+        self._stale = True
+
+    def refresh(self, session_factory, wait=False):
+        """Rebuild if needed: in this thread when wait is set, else in a background thread."""
+        if not self.needs_rebuild():
+            return
+        if wait:
+            with self._build_lock:
+                if self.needs_rebuild():
+                    self._build_with(session_factory)
+            return
+        if self._build_lock.locked():
+            return
+        threading.Thread(target=self._refresh_in_background, args=(session_factory,),
+                         name="suggest-index", daemon=True).start()
+
+    def _refresh_in_background(self, session_factory):
+        if not self._build_lock.acquire(blocking=False):
+            return
+        try:
+            if self.needs_rebuild():
+                self._build_with(session_factory)
+        except Exception as e:
+            print(f"Suggest index build failed: {str(e)}")
+            traceback.print_exc()
+        finally:
+            self._build_lock.release()
+
+    def _build_with(self, session_factory):
+        with session_factory() as session:
+            self.build(session)
+
+    # -- incremental updates ---------------------------------------------
+
+    def add(self, kind, entry_id, text):
+        """Add or replace one entry (kind is "book" or "author")."""
+        if not self.ready():
+            return  # the first build will read it from the database
+        normalized = normalize(text)
+        with self._lock:
+            self._remove_locked(kind, entry_id)
+            self._entries[(kind, entry_id)] = (text, normalized)
+            for key, position in _keys(normalized):
+                insort(self._keys, (key, kind, entry_id, position))
+                row = _row(self._entries, kind, entry_id, position)
+                for chars in range(1, len(key) + 1):
+                    self._results.pop(key[:chars])
+                    if key[:chars] in self._top:
+                        self._offer(self._top[key[:chars]], row)
+            self._version += 1
+
+    def _offer(self, top, row):
+        """Put a new match into a precomputed top list if it ranks high enough."""
+        if len(top) >= MAX_LIMIT and row >= top[-1]:
+            return
+        for i, other in enumerate(top):
+            if (other[3], other[2]) == (row[3], row[2]):
+                if other <= row:
+                    return
+                del top[i]
+                break
+        insort(top, row)
+        del top[MAX_LIMIT:]
+
+    def remove(self, kind, entry_id):
+        with self._lock:
+            self._remove_locked(kind, entry_id)
+            self._version += 1
+
+    def _remove_locked(self, kind, entry_id):
+        entry = self._entries.pop((kind, entry_id), None)
+        if entry is None:
+            return
+        keys = _keys(entry[1])
+        for key, position in keys:
+            i = bisect_left(self._keys, (key, kind, entry_id, position))
+            if i < len(self._keys) and self._keys[i] == (key, kind, entry_id, position):
+                del self._keys[i]
+        # a list that showed the entry is merged again, longest prefix
+        # first: the next best match (possibly a duplicate it was hiding)
+        # takes its place
+        prefixes = {key[:chars] for key, _ in keys for chars in range(1, len(key) + 1)}
+        for key_prefix in sorted(prefixes, key=len, reverse=True):
+            self._results.pop(key_prefix)
+            top = self._top.get(key_prefix, ())
+            if any(row[3] == kind and row[4] == entry_id for row in top):
+                start, end = _key_range(self._keys, key_prefix)
+                self._top[key_prefix] = _merge_children(
+                    self._keys, self._entries, key_prefix, start, end, self._top
+                )
+
+    # -- lookup ----------------------------------------------------------
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        """Best matches for a typed prefix, as {"type", "id", "text"} dicts.
+
+        Matches at the start of the text rank above matches at a later
+        word, then shorter texts first; duplicates of the same text are
+        dropped.
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        with self._lock:
+            best = self._top.get(prefix) if len(prefix) <= KEY_CHARS else None
+            if best is None:
+                best = self._results.get(prefix)
+            if best is None:
+                start, end = _key_range(self._keys, prefix[:KEY_CHARS])
+                candidates, entries, version = self._keys[start:end], self._entries, self._version
+            else:
+                best = best[:limit]
+        if best is None:
+            best = _rank(candidates, entries, prefix)
+            with self._lock:
+                # a write since the copy may have changed the answer
+                if self._version == version:
+                    self._results.set(prefix, best)
+        return [{"type": row[3], "id": row[4], "text": row[5]} for row in best[:limit]]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "keys": len(self._keys),
+                "age_seconds": None if self._built_at is None else time.monotonic() - self._built_at,
+                "stale": self._stale,
+                "ranked_prefixes": len(self._top),
+                "cached_prefixes": self._results.stats()["size"],
+            }
+
+
+suggest_index = SuggestIndex()
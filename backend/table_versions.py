@@ -0,0 +1,42 @@
+"""
+Per-table change counters.
+
+Write endpoints call bump() for the tables they changed once their commit
+succeeded. Caches key their entries on the versions of the tables they
+read, so any write makes them miss without keeping invalidation lists.
+
+The counters live in this process only; caches built on them also carry a
+short TTL so writes made by other worker processes are picked up.
+"""
+import threading
+import time
+
+
+class TableVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._changed_at = {}
+        self._started_at = time.time()
+
+    def bump(self, *tables):
+        now = time.time()
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._changed_at[table] = now
+
+    def get(self, table):
+        return self._versions.get(table, 0)
+
+    def key(self, tables):
+        """Tuple of the current versions of tables, usable as a cache key."""
+        return tuple(self._versions.get(t, 0) for t in tables)
+
+    def last_modified(self, tables):
+        """Unix time of the newest change to any of tables."""
+        return max([self._changed_at.get(t, self._started_at) for t in tables])
+
+
+table_versions = TableVersions()
+bump = table_versions.bump
@@ -1,6 +1,24 @@
 // API Base URL
 const API_BASE_URL = 'https://library-management-lawg.onrender.com';
 
+// ============ Helper: Read-your-writes ============
+/**
+ * After a write the API returns a signed X-Primary-Until token; sending it
+ * back keeps our reads on the primary database until it expires, so lists
+ * show the change we just made even when read replicas lag behind.
+ */
+function primaryUntilHeaders() {
+  const primaryUntil = sessionStorage.getItem('primaryUntil');
+  return primaryUntil ? { 'X-Primary-Until': primaryUntil } : {};
+}
+
+function rememberPrimaryUntil(response) {
+  const primaryUntil = response.headers.get('X-Primary-Until');
+  if (primaryUntil) {
+    sessionStorage.setItem('primaryUntil', primaryUntil);
+  }
+}
+
 // ============ Helper: Fetch with Token ============
 /**
  * Make API calls with authentication token
@@ -22,6 +40,7 @@ async function fetchWithToken(url, options = {}) {
   const headers = {
     'Content-Type': 'application/json',
     'Authorization': `Bearer ${token}`,
+    ...primaryUntilHeaders(),
     ...options.headers
   };
 
@@ -32,6 +51,7 @@ async function fetchWithToken(url, options = {}) {
     });
 
     console.log('Response status:', response.status);
+    rememberPrimaryUntil(response);
 
     // Handle 401 Unauthorized - token expired or invalid
     if (response.status === 401) {
@@ -363,6 +383,7 @@ async function searchBooks() {
       headers: {
         'Authorization': `Bearer ${localStorage.getItem('authToken')}`,
         'Content-Type': 'application/json',
+        ...primaryUntilHeaders(),
       },
     });
 
@@ -608,6 +629,7 @@ async function loadIssuedBooksData() {
       headers: {
         'Authorization': `Bearer ${token}`,
         'Content-Type': 'application/json',
+        ...primaryUntilHeaders(),
       },
     });
 
@@ -667,6 +689,7 @@ async function loadUsersData() {
       headers: {
         'Authorization': `Bearer ${token}`,
         'Content-Type': 'application/json',
+        ...primaryUntilHeaders(),
       },
     });
 
@@ -730,6 +753,7 @@ async function viewUserDetails(userId, userName) {
       headers: {
         'Authorization': `Bearer ${token}`,
         'Content-Type': 'application/json',
+        ...primaryUntilHeaders(),
       },
     });
 
@@ -901,7 +925,6 @@ async function handleAddBook(e) {
     author_name: document.getElementById('authorName').value,
     isbn: document.getElementById('bookISBN').value,
     category: document.getElementById('bookCategory').value,
-    status: document.getElementById('bookStatus').value,
     description: document.getElementById('bookDescription').value
   };
   
@@ -1,20 +1,210 @@
 #!/usr/bin/env python3
 """
-Simple HTTP server to serve the Library Management Dashboard
+HTTP server for the Library Management Dashboard
 Run this in the frontend_new directory to serve the dashboard
+
+Every request is handled on its own thread, so one slow client does not
+hold up the others. At startup each text asset (HTML, CSS, JS, SVG, ...)
+is compressed once with gzip, and with brotli when the brotli package is
+installed; requests get the smallest variant their Accept-Encoding allows.
+
+Responses carry a strong ETag (a hash of the content, one per encoding)
+and answer If-None-Match with 304 Not Modified. Content-hashed file names
+(app.3f9a1c2e.js) are cached by browsers for a year as immutable; other
+files are revalidated on every load. Large files that are not compressed
+(library-hero.jpg) are written with sendfile(). Files edited while the
+server runs are picked up on the next request.
+
+Usage:
+    python serve.py [--port 8000] [--bind 0.0.0.0] [--single-thread]
 """
 
+import argparse
+import email.utils
+import gzip
+import hashlib
 import http.server
-import socketserver
+import mimetypes
 import os
+import posixpath
+import re
+import socketserver
+import threading
+import urllib.parse
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
 
 PORT = 8000
 DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 
-class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=DIRECTORY, **kwargs)
-    
+# types worth compressing; images and fonts already are
+COMPRESSIBLE_TYPES = {
+    "application/javascript", "application/json", "application/xml",
+    "image/svg+xml", "text/css", "text/html", "text/javascript",
+    "text/markdown", "text/plain", "text/xml",
+}
+# files smaller than this gain nothing from compression
+MIN_COMPRESS_SIZE = 512
+# uncompressed bodies at least this large are sent with sendfile()
+# instead of being held in memory
+SENDFILE_MIN_SIZE = 64 * 1024
+
+# name.<8+ hex digits>.ext, e.g. dashboard.3f9a1c2e.css
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.[a-z0-9]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# preferred first when the client accepts several
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+ETAG_SUFFIX = {"br": "-br", "gzip": "-gz"}
+
+mimetypes.add_type("text/markdown", ".md")
+mimetypes.add_type("application/javascript", ".js")
+
+
+class Asset:
+    """One file: its identity headers plus the body in every stored encoding."""
+
+    def __init__(self, path):
+        stat = os.stat(path)
+        self.path = path
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or "application/octet-stream"
+        compressible = content_type in COMPRESSIBLE_TYPES
+        if compressible or content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        self.cache_control = IMMUTABLE if HASHED_NAME.search(path) else REVALIDATE
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.tag = digest.hexdigest()[:32]
+
+        # encoding -> bytes; None (identity) is absent when it is sent with sendfile()
+        self.bodies = {}
+        if self.size < SENDFILE_MIN_SIZE or compressible:
+            with open(path, "rb") as f:
+                self.bodies[None] = f.read()
+        if compressible and self.size >= MIN_COMPRESS_SIZE:
+            self._precompress(self.bodies[None])
+        self.vary = len(self.bodies) > 1
+
+    def _precompress(self, raw):
+        variants = {"gzip": gzip.compress(raw, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(raw, quality=11)
+        for encoding, body in variants.items():
+            if len(body) < len(raw):
+                self.bodies[encoding] = body
+
+    def is_stale(self, stat):
+        return stat.st_mtime_ns != self.mtime or stat.st_size != self.size
+
+    def etag(self, encoding):
+        return f'"{self.tag}{ETAG_SUFFIX.get(encoding, "")}"'
+
+    def pick_encoding(self, accept_encoding):
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ENCODINGS:
+            if encoding in self.bodies and encoding in accepted:
+                return encoding
+        return None
+
+
+def parse_accept_encoding(header):
+    """Encodings the client accepts (q > 0); "*" is expanded to the known ones."""
+    accepted = set()
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if not name or q <= 0:
+            continue
+        if name == "*":
+            accepted.update(ENCODINGS)
+        else:
+            accepted.add(name)
+    return accepted
+
+
+class AssetStore:
+    """Assets by URL path, built at startup and rebuilt when a file changes on disk."""
+
+    def __init__(self, directory):
+        self.directory = os.path.realpath(directory)
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def preload(self):
+        raw = compressed = 0
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not self._hidden(d)]
+            for name in files:
+                if self._hidden(name):
+                    continue
+                url_path = "/" + os.path.relpath(os.path.join(root, name), self.directory).replace(os.sep, "/")
+                asset = self.get(url_path)
+                if asset is not None:
+                    raw += asset.size
+                    compressed += min(len(body) for body in asset.bodies.values()) if asset.bodies else asset.size
+        return len(self._assets), raw, compressed
+
+    @staticmethod
+    def _hidden(name):
+        return name.startswith(".") or name == "__pycache__"
+
+    def resolve(self, url_path):
+        """Absolute file path for a URL path, or None when it is outside the directory."""
+        path = posixpath.normpath(urllib.parse.unquote(url_path))
+        parts = [p for p in path.split("/") if p]
+        if any(self._hidden(p) for p in parts):
+            return None
+        full = os.path.realpath(os.path.join(self.directory, *parts))
+        if full != self.directory and not full.startswith(self.directory + os.sep):
+            return None
+        if os.path.isdir(full):
+            full = os.path.join(full, "index.html")
+        return full
+
+    def get(self, url_path):
+        path = self.resolve(url_path)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        asset = self._assets.get(path)
+        if asset is None or asset.is_stale(stat):
+            try:
+                asset = Asset(path)
+            except OSError:
+                return None
+            with self._lock:
+                self._assets[path] = asset
+        return asset
+
+
+class StaticHandler(http.server.BaseHTTPRequestHandler):
+    store = None
+    protocol_version = "HTTP/1.1"
+
     def end_headers(self):
         # Add CORS headers
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -22,12 +212,100 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
         super().end_headers()
 
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        url_path = urllib.parse.urlsplit(self.path).path
+        if url_path == "/":
+            url_path = "/index.html"
+        asset = self.store.get(url_path)
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+
+        encoding = asset.pick_encoding(self.headers.get("Accept-Encoding"))
+        etag = asset.etag(encoding)
+
+        if self.not_modified(asset, etag):
+            self.send_response(304)
+            self.send_identity_headers(asset, etag)
+            self.end_headers()
+            return
+
+        body = asset.bodies.get(encoding)
+        self.send_response(200)
+        self.send_identity_headers(asset, etag)
+        self.send_header("Content-Type", asset.content_type)
+        self.send_header("Content-Length", str(len(body) if body is not None else asset.size))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        if not send_body:
+            return
+        if body is not None:
+            self.wfile.write(body)
+        else:
+            with open(asset.path, "rb") as f:
+                self.connection.sendfile(f)
+
+    def send_identity_headers(self, asset, etag):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", asset.last_modified)
+        self.send_header("Cache-Control", asset.cache_control)
+        if asset.vary:
+            self.send_header("Vary", "Accept-Encoding")
+
+    def not_modified(self, asset, etag):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since
+            tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+            return "*" in tags or etag in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(asset.mtime // 1_000_000_000) <= since.timestamp()
+        return False
+
+
+class ThreadingServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the Library Management frontend")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", PORT)))
+    parser.add_argument("--bind", default="")
+    parser.add_argument("--single-thread", action="store_true",
+                        help="handle one request at a time (debugging)")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    StaticHandler.store = AssetStore(DIRECTORY)
+    count, raw, compressed = StaticHandler.store.preload()
+    server_class = socketserver.TCPServer if args.single_thread else ThreadingServer
     try:
-        with socketserver.TCPServer(("", PORT), MyHTTPRequestHandler) as httpd:
-            print(f"✅ Frontend server running at http://localhost:{PORT}")
+        with server_class((args.bind, args.port), StaticHandler) as httpd:
+            print(f"✅ Frontend server running at http://localhost:{args.port}")
             print(f"📂 Serving files from: {DIRECTORY}")
-            print(f"🚀 Open dashboard: http://localhost:{PORT}/dashboard.html")
+            print(f"🗜  {count} files, {raw / 1024:.0f} KiB -> {compressed / 1024:.0f} KiB over the wire "
+                  f"({', '.join(ENCODINGS)}{'' if brotli else '; pip install brotli for br'})")
+            print(f"🚀 Open dashboard: http://localhost:{args.port}/dashboard.html")
             print(f"\n⚠️  Make sure backend is running at http://127.0.0.1:5000")
             print(f"Press CTRL+C to stop")
             httpd.serve_forever()
@@ -35,7 +313,7 @@ if __name__ == "__main__":
         print("\n✅ Server stopped")
     except OSError as e:
         if "Address already in use" in str(e):
-            print(f"❌ Port {PORT} is already in use.")
+            print(f"❌ Port {args.port} is already in use.")
             print(f"Try killing the process or using a different port.")
         else:
             print(f"❌ Error: {e}")